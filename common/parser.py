@@ -84,7 +84,7 @@ def attachment(preview: str):
 
 class ParserError(Exception):
     def __init__(self, message: str, dump=None):
-        super().__init__()
+        super().__init__(message, dump)  # Keep picklable for process pools
         self.message = message
         self.dump = dump
 
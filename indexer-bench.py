@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+import asyncio
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import time
+
+from indexer import (
+    cache,
+    distributed,
+    f95zone,
+    metrics,
+    threads,
+    versions,
+)
+
+# Thread IDs near the top of the valid range, real threads won't be there for a
+# long time, but still only run this against a local Redis
+BENCH_IDS = range(990_000, 991_000)
+BENCH_ROUNDS = 2000
+BENCH_PROCESSES = 8
+BENCH_LOCK_ROUNDS = 50
+BENCH_LOCK_LEASE = 2.0
+BENCH_LIMITER_RATE = 20
+BENCH_LIMITER_PERIOD = 1.0
+BENCH_LIMITER_ROUNDS = 10
+BENCH_SCRAPERS = 8
+BENCH_SCRAPES = 3
+BENCH_KEY_FORMAT = "bench:{name}"
+
+logger = logging.getLogger()
+
+
+# Compare /fast freshness lookups against the old way of two round trips per ID
+async def fast() -> None:
+    cache.redis = metrics.redis_client(decode_responses=True)
+    await cache.redis.ping()
+    now = int(time.time())
+    seed_data = cache.redis.pipeline()
+    for id in BENCH_IDS:
+        seed_data.hset(
+            cache.NAME_FORMAT.format(id=id),
+            mapping={
+                cache.LAST_CACHED: now,
+                cache.EXPIRE_TIME: now + 86400,
+                cache.LAST_CHANGE: now,
+            },
+        )
+    await seed_data.execute()
+
+    try:
+        cache.hot_cache.max_bytes = 0
+        await _bench_fast("per id", _last_changes_per_id)
+        await _bench_fast("pipeline", cache.last_changes)
+        cache.hot_cache.max_bytes = cache.HOT_CACHE_DEFAULT_MB * 1024 * 1024
+        await _bench_fast("hot cache", cache.last_changes)
+    finally:
+
+        await cache.redis.delete(*(cache.NAME_FORMAT.format(id=id) for id in BENCH_IDS))
+        await cache.redis.aclose()
+
+
+async def _bench_fast(label: str, last_changes) -> None:
+    timings = []
+    round_trips = metrics.REDIS_ROUND_TRIPS.values.get((), 0)
+    for _ in range(BENCH_ROUNDS):
+        ids = random.sample(BENCH_IDS, threads.FAST_MAX_IDS)
+        start = time.perf_counter()
+        await last_changes(ids)
+        timings.append(time.perf_counter() - start)
+    round_trips = metrics.REDIS_ROUND_TRIPS.values.get((), 0) - round_trips
+    timings.sort()
+    logger.info(
+        f"{label:>10}: p50 {statistics.median(timings) * 1000:.3f}ms,"
+        f" p99 {timings[int(len(timings) * 0.99)] * 1000:.3f}ms,"
+        f" {round_trips / BENCH_ROUNDS:.1f} round trips per {threads.FAST_MAX_IDS} IDs"
+    )
+
+
+async def _last_changes_per_id(ids: list[int]) -> dict[int, int]:
+    # Freshness check then last change, for each ID on its own
+    async def last_change(id: int) -> int:
+        name = cache.NAME_FORMAT.format(id=id)
+        await cache.redis.hmget(name, (cache.LAST_CACHED, cache.EXPIRE_TIME))
+        return int(await cache.redis.hget(name, cache.LAST_CHANGE) or 0)
+
+    return dict(zip(ids, await asyncio.gather(*(last_change(id) for id in ids))))
+
+
+# Check the lock and token bucket hold up with processes racing for them
+async def distributed_() -> None:
+    async with distributed.lifespan():
+        await distributed.redis.delete(
+            distributed.LOCK_FORMAT.format(name=BENCH_KEY_FORMAT.format(name="lock")),
+            distributed.LIMITER_FORMAT.format(
+                name=BENCH_KEY_FORMAT.format(name="limiter")
+            ),
+            *(
+                BENCH_KEY_FORMAT.format(name=name)
+                for name in ("counter", "holders", "overlaps", "held")
+            ),
+        )
+
+    spawn = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(BENCH_PROCESSES, spawn) as pool:
+        list(pool.map(_run, [_lock_worker] * BENCH_PROCESSES))
+        async with distributed.lifespan():
+            counter, overlaps = await distributed.redis.mget(
+                BENCH_KEY_FORMAT.format(name="counter"),
+                BENCH_KEY_FORMAT.format(name="overlaps"),
+            )
+        expected = BENCH_PROCESSES * BENCH_LOCK_ROUNDS
+        logger.info(
+            f"Lock: {counter} of {expected} increments, {overlaps or 0} overlaps"
+        )
+        ok = int(counter or 0) == expected and not overlaps
+
+        # A holder that dies without releasing blocks others for at most the lease
+        holder = spawn.Process(target=_run, args=(_dead_holder,))
+        holder.start()
+        holder.join()
+        waited = await _lock_wait()
+        logger.info(f"Lock: dead holder's lease ran out after {waited:.2f}s")
+        ok = ok and waited <= BENCH_LOCK_LEASE + 1
+
+        start = time.time()
+        grants = sum(pool.map(_run, [_limiter_worker] * BENCH_PROCESSES), [])
+    grants.sort()
+    # Bucket starts full, then refills at rate, any window can't go over both
+    capacity = max(1, BENCH_LIMITER_RATE)
+    overruns = 0
+    for index, granted in enumerate(grants):
+        window = [
+            other for other in grants[index:] if other - granted <= BENCH_LIMITER_PERIOD
+        ]
+        allowed = capacity + BENCH_LIMITER_RATE
+        overruns += len(window) > allowed
+    elapsed = grants[-1] - start
+    expected = (len(grants) - capacity) / BENCH_LIMITER_RATE * BENCH_LIMITER_PERIOD
+    logger.info(
+        f"Limiter: {len(grants)} grants in {elapsed:.2f}s, expected"
+        f" {expected:.2f}s, {overruns} windows over the rate"
+    )
+    ok = ok and not overruns and elapsed >= expected * 0.9
+
+    async with distributed.lifespan():
+        await distributed.redis.delete(
+            distributed.LIMITER_FORMAT.format(
+                name=BENCH_KEY_FORMAT.format(name="limiter")
+            ),
+            *(
+                BENCH_KEY_FORMAT.format(name=name)
+                for name in ("counter", "holders", "overlaps", "held")
+            ),
+        )
+    logger.info("Distributed checks " + ("passed" if ok else "FAILED"))
+    if not ok:
+        sys.exit(1)
+
+
+# Check version lookups from scrapes paced by the ratelimit end up batched
+async def versions_() -> None:
+    requests = []
+
+    async def fetch_versions(ids: list[int]) -> dict[str, str]:
+        requests.append(len(ids))
+        return {}
+
+    # Own limiter with the same pace, don't use up the real one
+    versions._fetch_versions = fetch_versions
+    f95zone.RATELIMIT = distributed.AdaptiveLimiter(
+        BENCH_KEY_FORMAT.format(name="f95zone"),
+        f95zone.RATELIMIT.max_rate,
+        f95zone.RATELIMIT.time_period,
+        f95zone.RATELIMIT.floor_rate,
+        f95zone.RATELIMIT.ceiling_rate,
+    )
+
+    async def scraper(first_id: int) -> None:
+        for id in range(first_id, first_id + BENCH_SCRAPES):
+            async with f95zone.RATELIMIT:
+                pass  # Thread page
+            await versions.lookup(id)
+            async with f95zone.RATELIMIT:
+                pass  # Reviews page
+
+    async with distributed.lifespan():
+        await distributed.redis.delete(
+            distributed.LIMITER_FORMAT.format(name=f95zone.RATELIMIT.name)
+        )
+        await asyncio.gather(
+            *(scraper(index * BENCH_SCRAPES) for index in range(BENCH_SCRAPERS))
+        )
+        await distributed.redis.delete(
+            distributed.LIMITER_FORMAT.format(name=f95zone.RATELIMIT.name)
+        )
+
+    lookups = sum(requests)
+    logger.info(
+        f"Versions: {lookups} lookups in {len(requests)} requests,"
+        f" largest batch {max(requests)}"
+    )
+    # Without batching it would be one request per lookup
+    if len(requests) > lookups / 2:
+        logger.error("Versions checks FAILED")
+        sys.exit(1)
+    logger.info("Versions checks passed")
+
+
+# Check future timestamps are rejected before they reach the cache
+async def timestamps() -> None:
+    id = BENCH_IDS[0]
+    now = int(time.time())
+    future = now + 3600
+    responses = {
+        "ts": await threads.full_request(None, id, future),
+        "since": await threads.full_request(None, id, now, since=future),
+        "bulk ts": await threads.full_bulk_request(None, f"{id}:{future}"),
+        "bulk since": await threads.full_bulk_request(None, f"{id}:{now}:{future}"),
+    }
+    ok = True
+    for label, response in responses.items():
+        logger.info(f"Future {label}: {response.status_code} {response.body.decode()}")
+        ok = ok and response.status_code == 406
+    if not ok:
+        logger.error("Timestamps checks FAILED")
+        sys.exit(1)
+    logger.info("Timestamps checks passed")
+
+
+def _run(worker):
+    # Each process has its own event loop and Redis connections
+    return asyncio.run(worker())
+
+
+async def _lock_worker() -> None:
+    # Read and write back a counter slowly, lost updates mean the lock leaked
+    name = BENCH_KEY_FORMAT.format(name="lock")
+    async with distributed.lifespan():
+        redis = distributed.redis
+        for _ in range(BENCH_LOCK_ROUNDS):
+            async with distributed.lock(name, BENCH_LOCK_LEASE):
+                if await redis.incr(BENCH_KEY_FORMAT.format(name="holders")) > 1:
+                    await redis.incr(BENCH_KEY_FORMAT.format(name="overlaps"))
+                counter = int(
+                    await redis.get(BENCH_KEY_FORMAT.format(name="counter")) or 0
+                )
+                await asyncio.sleep(random.uniform(0, 0.005))
+                await redis.set(BENCH_KEY_FORMAT.format(name="counter"), counter + 1)
+                await redis.decr(BENCH_KEY_FORMAT.format(name="holders"))
+
+
+async def _dead_holder() -> None:
+    name = BENCH_KEY_FORMAT.format(name="lock")
+    async with distributed.lifespan():
+        async with distributed.lock(name, BENCH_LOCK_LEASE):
+            await distributed.redis.set(BENCH_KEY_FORMAT.format(name="held"), 1)
+            os._exit(0)
+
+
+async def _lock_wait() -> float:
+    name = BENCH_KEY_FORMAT.format(name="lock")
+    async with distributed.lifespan():
+        assert await distributed.redis.get(BENCH_KEY_FORMAT.format(name="held"))
+        start = time.perf_counter()
+        async with distributed.lock(name, BENCH_LOCK_LEASE):
+            return time.perf_counter() - start
+
+
+async def _limiter_worker() -> list[float]:
+    limiter = distributed.Limiter(
+        BENCH_KEY_FORMAT.format(name="limiter"),
+        BENCH_LIMITER_RATE,
+        BENCH_LIMITER_PERIOD,
+    )
+    grants = []
+    async with distributed.lifespan():
+        for _ in range(BENCH_LIMITER_ROUNDS):
+            async with limiter:
+                grants.append(time.time())
+    return grants
+
+
+def main() -> None:
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+
+    modes = {
+        "fast": fast,
+        "distributed": distributed_,
+        "versions": versions_,
+        "timestamps": timestamps,
+    }
+    if len(sys.argv) != 2 or sys.argv[1] not in modes:
+        logger.error(f"Usage: {sys.argv[0]} {{{','.join(modes)}}}")
+        sys.exit(1)
+    asyncio.run(modes[sys.argv[1]]())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,28 @@
 #!/usr/bin/env python3
+import asyncio
 import contextlib
 import logging
 import os
 import pathlib
 import re
+import sys
 
+import dotenv
 import fastapi
 import uvicorn
 
 from indexer import (
     cache,
+    distributed,
+    eviction,
     f95zone,
+    jobs,
+    metrics,
+    monitoring,
+    parsing,
+    scheduler,
     threads,
+    tracing,
     watcher,
 )
 
@@ -21,15 +32,50 @@ logger = logging.getLogger()
 @contextlib.asynccontextmanager
 async def lifespan(app: fastapi.FastAPI):
     async with (
+        metrics.lifespan(),
+        tracing.lifespan(),
+        distributed.lifespan(),
+        jobs.lifespan(),
         cache.lifespan(),
         f95zone.lifespan(),
+        parsing.lifespan(),
+        jobs.workers(cache.scrape_thread),
         watcher.lifespan(),
+        scheduler.lifespan(),
+        eviction.lifespan(),
+        monitoring.lifespan(),
     ):
         yield
 
 
+# Only consume scrape jobs from the queue, without serving the API
+async def scraper() -> None:
+    async with (
+        metrics.lifespan(),
+        tracing.lifespan(),
+        distributed.lifespan(),
+        jobs.lifespan(),
+        cache.lifespan(),
+        f95zone.lifespan(),
+        parsing.lifespan(),
+        jobs.workers(cache.scrape_thread),
+    ):
+        if not jobs.enabled:
+            logger.error("SCRAPE_QUEUE is disabled, nothing to do")
+            return
+        await asyncio.Event().wait()
+
+
+# Train the thread storage dictionary and repack cached threads with it
+async def codec() -> None:
+    async with cache.lifespan():
+        await cache.migrate_codec()
+
+
 app = fastapi.FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None)
+app.middleware("http")(metrics.middleware)
 app.include_router(threads.router)
+app.include_router(monitoring.router)
 
 
 def main() -> None:
@@ -38,11 +84,21 @@ def main() -> None:
     log_handler.setFormatter(_ColourFormatter())
     logger.addHandler(log_handler)
 
+    # Before anything reads it, like the number of workers below
+    dotenv.load_dotenv("indexer.env")
+
+    if sys.argv[1:] == ["scraper"]:
+        asyncio.run(scraper())
+        return
+    if sys.argv[1:] == ["codec"]:
+        asyncio.run(codec())
+        return
+
     uvicorn.run(
         "indexer-main:app",
         host=os.environ.get("BIND_HOST", "127.0.0.1"),
-        port=int(os.environ.get("BIND_HOST", 8069)),
-        workers=1,
+        port=int(os.environ.get("BIND_PORT", 8069)),
+        workers=int(os.environ.get("WORKERS", 1)),
         log_config=None,
         log_level=logging.INFO,
         access_log=False,
@@ -1,20 +1,55 @@
 import asyncio
+import collections
 import contextlib
 import datetime as dt
+import gzip
+import json
 import logging
+import os
+import statistics
 import time
 
 import redis.asyncio as aredis
+import zstandard
 
 from common import meta
+from common.structs import Status
 from external import error
 from indexer import (
+    distributed,
     f95zone,
+    jobs,
+    metrics,
+    reviews,
     scraper,
 )
 
 CACHE_TTL = dt.timedelta(days=7).total_seconds()
 SHORT_TTL = dt.timedelta(days=2).total_seconds()
+# Learned from how often threads change, within bounds for their status
+EXPIRE_HISTORY_SIZE = 8
+# Only updates, score and votes change on almost every scrape of popular threads
+# so learning from them would keep shortening the TTL
+EXPIRE_HISTORY_FIELDS = ("version", "status")
+EXPIRE_CHANGE_SHARE = 0.5
+EXPIRE_BOUNDS = {
+    Status.Normal: (
+        dt.timedelta(days=1).total_seconds(),
+        dt.timedelta(days=7).total_seconds(),
+    ),
+    Status.OnHold: (
+        dt.timedelta(days=3).total_seconds(),
+        dt.timedelta(days=14).total_seconds(),
+    ),
+    Status.Completed: (
+        dt.timedelta(days=7).total_seconds(),
+        dt.timedelta(days=30).total_seconds(),
+    ),
+    Status.Abandoned: (
+        dt.timedelta(days=14).total_seconds(),
+        dt.timedelta(days=60).total_seconds(),
+    ),
+}
 LAST_CHANGE_ELIGIBLE_FIELDS = (
     "name",
     "version",
@@ -38,8 +73,18 @@ LAST_CHANGE_ELIGIBLE_FIELDS = (
 
 logger = logging.getLogger(__name__)
 redis: aredis.Redis = None
+redis_raw: aredis.Redis = None  # For binary values
 locks_lock = asyncio.Lock()
 locks: dict[asyncio.Lock] = {}
+stale_while_revalidate = False
+revalidating: dict[int, asyncio.Task] = {}
+accessed: dict[int, int] = {}
+pack_fields = False
+admission_scrapes = 0.0
+client_header = ""
+codec_dicts: dict[int, zstandard.ZstdCompressionDict] = {}
+codec_compressor: zstandard.ZstdCompressor = None
+codec_decompressors: dict[int, zstandard.ZstdDecompressor] = {}
 
 LAST_CACHED = "LAST_CACHED"
 EXPIRE_TIME = "EXPIRE_TIME"
@@ -48,124 +93,1070 @@ INTERNAL_KEYWORDS = (
     CACHED_WITH := "CACHED_WITH",
     LAST_CHANGE := "LAST_CHANGE",
     HASHED_META := "HASHED_META",
+    FIELD_CHANGES := "FIELD_CHANGES",
+    SCRAPE_STATE := "SCRAPE_STATE",
+    CHANGE_HISTORY := "CHANGE_HISTORY",
+    EXPIRE_POLICY := "EXPIRE_POLICY",
+    PACKED := "PACKED",
 )
 NAME_FORMAT = "thread:{id}"
+BODY_FORMAT = "body:{id}"
+BODY_REVISION = "revision"
+BODY_INDEX_ERROR = "index_error"
+BODY_ENCODINGS = (
+    BODY_IDENTITY := "identity",
+    BODY_GZIP := "gzip",
+    BODY_ZSTD := "zstd",
+)
+BODY_GZIP_LEVEL = 9
+BODY_ZSTD_LEVEL = 10
+EXPIRE_INDEX = "index:expire_time"
+CHANGE_INDEX = "index:last_change"
+# When threads were last requested, written in batches to keep requests cheap
+ACCESS_INDEX = "index:last_access"
+ACCESS_FLUSH_INTERVAL = dt.timedelta(seconds=30).total_seconds()
+EXPIRE_STATS = "stats:expire"
+BUILD_INDEXES_CHUNK_SIZE = 1000
+# In-process copies of hot freshness values and bodies, dropped when any worker
+# updates or invalidates a thread, TTL covers messages missed while reconnecting
+HOT_CACHE_CHANNEL = "cache:invalidate"
+HOT_CACHE_DEFAULT_MB = 64
+HOT_CACHE_TTL = dt.timedelta(minutes=1).total_seconds()
+HOT_CACHE_ENTRY_OVERHEAD = 200
+HOT_CACHE_RECONNECT_DELAY = 5
+
+# Large fields only ever read whole, optionally stored in PACKED as one blob
+# compressed with a dictionary trained on cached threads
+PACKED_FIELDS = (
+    "description",
+    "changelog",
+    "tags",
+    "unknown_tags",
+    "previews_urls",
+    "downloads",
+    "reviews",
+)
+CODEC_DICTS = "codec:dicts"
+CODEC_CURRENT = "current"
+CODEC_LEVEL = 10
+CODEC_DICT_SIZE = 112 * 1024
+CODEC_TRAIN_SAMPLES = 10000
+CODEC_TRAIN_MIN_SAMPLES = 100
+CODEC_MIGRATE_CHUNK_SIZE = 1000
+# Only repack if the thread wasn't scraped again since it was read
+CODEC_MIGRATE_SCRIPT = """
+if (redis.call("HGET", KEYS[1], ARGV[1]) or "") ~= ARGV[2] then
+    return 0
+end
+redis.call("HSET", KEYS[1], ARGV[3], ARGV[4])
+redis.call("HDEL", KEYS[1], unpack(ARGV, 5))
+return 1
+"""
+
+# Threads found missing before ever being cached get a bit instead of a hash,
+# bitmaps rotate so they're checked again about as often as cached missing ones
+MISSING_FORMAT = "index:missing:{generation}"
+MISSING_GENERATION = f95zone.ERROR_THREAD_MISSING.retry_delay
+# IDs too far past the newest thread seen can't exist yet
+TOP_ID_INDEX = "index:top_id"
+TOP_ID_MEMBER = "top"
+TOP_ID_MARGIN = 10000
+# Scrapes each client can cause, beyond that uncached threads are shed
+ADMISSION_FORMAT = "admission:{client}"
+ADMISSION_DEFAULT_SCRAPES = 30
+ADMISSION_PERIOD = dt.timedelta(minutes=1).total_seconds()
+
+# Reported to clients in the STATUS_HEADER response header
+STATUS_HEADER = "X-Indexer-Cache"
+STATUS_FRESH = "fresh"
+STATUS_SCRAPED = "scraped"
+STATUS_STALE = "stale"
+STATUS_SHED = "shed"
+
+
+class HotCache:
+    # LRU bounded by total bytes, entries also expire after a while
+    __slots__ = (
+        "max_bytes",
+        "ttl",
+        "entries",
+        "size",
+        "hits",
+        "misses",
+        "invalidations",
+    )
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries: collections.OrderedDict[tuple, tuple] = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # Bumped on every invalidation, so reads racing one don't store old data
+        self.invalidations = 0
+
+    def get(self, key: tuple) -> tuple | None:
+        if not self.max_bytes:
+            return None
+        entry = self.entries.get(key)
+        if entry is None or entry[2] <= time.monotonic():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            metrics.HOT_CACHE_LOOKUPS.inc("miss")
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        metrics.HOT_CACHE_LOOKUPS.inc("hit")
+        return entry[0]
+
+    def put(self, key: tuple, value: tuple, size: int, since: int) -> None:
+        if not self.max_bytes or since != self.invalidations:
+            return
+        size += HOT_CACHE_ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (value, size, time.monotonic() + self.ttl)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+        metrics.HOT_CACHE_BYTES.set(value=self.size)
+
+    def invalidate(self, id: int) -> None:
+        self.invalidations += 1
+        for key in (("meta", id), *(("body", id, enc) for enc in BODY_ENCODINGS)):
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self) -> None:
+        self.invalidations += 1
+        self.entries.clear()
+        self.size = 0
+        metrics.HOT_CACHE_BYTES.set(value=self.size)
+
+    def stats(self) -> dict[str, int | float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+        }
+
+    def _remove(self, key: tuple) -> None:
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+        metrics.HOT_CACHE_BYTES.set(value=self.size)
+
+
+hot_cache = HotCache(0, HOT_CACHE_TTL)
 
 
 @contextlib.asynccontextmanager
 async def lifespan():
-    global redis
-    redis = aredis.Redis(decode_responses=True)
+    global redis, redis_raw, stale_while_revalidate, pack_fields
+    global admission_scrapes, client_header
+    redis = metrics.redis_client(decode_responses=True)
     await redis.ping()
+    redis_raw = metrics.redis_client(decode_responses=False)
+    build_indexes_task = asyncio.create_task(build_indexes())
+    stale_while_revalidate = os.environ.get("STALE_WHILE_REVALIDATE", "").lower() in (
+        "1",
+        "true",
+        "yes",
+    )
+    hot_cache.max_bytes = int(
+        float(os.environ.get("HOT_CACHE_MB") or HOT_CACHE_DEFAULT_MB) * 1024 * 1024
+    )
+    hot_cache.clear()
+    watch_invalidations_task = (
+        asyncio.create_task(watch_invalidations()) if hot_cache.max_bytes else None
+    )
+    flush_accessed_task = asyncio.create_task(flush_accessed())
+    pack_fields = os.environ.get("PACK_FIELDS", "").lower() in ("1", "true", "yes")
+    await _load_codec_dicts()
+    client_header = os.environ.get("CLIENT_IP_HEADER") or ""
+    admission_scrapes = float(
+        os.environ.get("ADMISSION_SCRAPES_PER_MINUTE") or ADMISSION_DEFAULT_SCRAPES
+    )
+    if admission_scrapes and not client_header:
+        # Behind the reverse proxy all clients would share its address and budget
+        logger.warning(
+            "CLIENT_IP_HEADER is not set, scrapes are not limited per client"
+        )
+        admission_scrapes = 0.0
 
     try:
         yield
     finally:
 
+        build_indexes_task.cancel()
+        if watch_invalidations_task:
+            watch_invalidations_task.cancel()
+        flush_accessed_task.cancel()
+        for task in list(revalidating.values()):
+            task.cancel()
+        try:
+            await _flush_accessed()
+        except Exception:
+            logger.error(f"Error saving accesses: {error.text()}\n{error.traceback()}")
         await redis.aclose()
+        await redis_raw.aclose()
         redis = None
+        redis_raw = None
 
 
 # https://stackoverflow.com/a/67057328
 @contextlib.asynccontextmanager
 async def lock(id: int):
+    start = time.perf_counter()
     async with locks_lock:
         if not locks.get(id):
             locks[id] = asyncio.Lock()
     async with locks[id]:
-        yield
+        # Local lock avoids polling Redis, lease keeps other workers and hosts out
+        async with distributed.lock(NAME_FORMAT.format(id=id)):
+            metrics.LOCK_WAIT_SECONDS.observe(time.perf_counter() - start)
+            yield
     async with locks_lock:
         if (lock := locks.get(id)) and not lock.locked() and not lock._waiters:
             del locks[id]
 
 
-async def last_change(id: int) -> int:
+async def watch_invalidations() -> None:
+    while True:
+        try:
+            async with redis.pubsub(ignore_subscribe_messages=True) as pubsub:
+                await pubsub.subscribe(HOT_CACHE_CHANNEL)
+                # Anything could have changed while not subscribed
+                hot_cache.clear()
+                async for message in pubsub.listen():
+                    hot_cache.invalidate(int(message["data"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.error(
+                f"Error watching invalidations: {error.text()}\n{error.traceback()}"
+            )
+        hot_cache.clear()
+        await asyncio.sleep(HOT_CACHE_RECONNECT_DELAY)
+
+
+async def flush_accessed() -> None:
+    while True:
+        await asyncio.sleep(ACCESS_FLUSH_INTERVAL)
+        try:
+            await _flush_accessed()
+        except Exception:
+            logger.error(f"Error saving accesses: {error.text()}\n{error.traceback()}")
+
+
+def invalidate(pipeline: aredis.client.Pipeline, id: int | str) -> None:
+    # Drop hot copies of this thread in all workers once the pipeline runs
+    pipeline.publish(HOT_CACHE_CHANNEL, str(id))
+
+
+async def last_changes(
+    ids: list[int], client: str | None = None
+) -> tuple[dict[int, int], str]:
+    assert all(isinstance(id, int) for id in ids)
+    names = {id: NAME_FORMAT.format(id=id) for id in ids}
+    logger.debug(f"Last changes {', '.join(names.values())}")
+    _touch(ids)
+
+    # Resolve freshness and last change of all threads in one round trip
+    cached_data = {id: hot_cache.get(("meta", id)) for id in ids}
+    missing = [id for id, values in cached_data.items() if values is None]
+    if missing:
+        since = hot_cache.invalidations
+        missing_data = redis.pipeline()
+        for id in missing:
+            missing_data.hmget(names[id], (LAST_CACHED, EXPIRE_TIME, LAST_CHANGE))
+        missing_data = await missing_data.execute()
+        for id, values in zip(missing, missing_data):
+            cached_data[id] = values = tuple(values)
+            hot_cache.put(("meta", id), values, 0, since)
+
+    last_changes = {}
+    outdated = []
+    for id, (last_cached, expire_time, last_change) in cached_data.items():
+        if _is_outdated(last_cached, expire_time):
+            outdated.append((id, bool(last_change)))
+        else:
+            last_changes[id] = int(last_change or 0)
+
+    # Only the stale subset needs to go through the update path
+    statuses = [STATUS_FRESH]
+    metrics.CACHE_LOOKUPS.inc(STATUS_FRESH, amount=len(cached_data) - len(outdated))
+    if outdated:
+        statuses += await asyncio.gather(
+            *(
+                _refresh_thread_cache(id, names[id], cached, client)
+                for id, cached in outdated
+            )
+        )
+        updated_data = redis.pipeline()
+        for id, _ in outdated:
+            updated_data.hget(names[id], LAST_CHANGE)
+        updated_data = await updated_data.execute()
+        for (id, _), status, last_change in zip(outdated, statuses[1:], updated_data):
+            if last_change:
+                last_changes[id] = int(last_change)
+            elif status != STATUS_SHED:
+                # No hash, but clients need a change to ask /full for the error,
+                # shed threads are left out for clients to ask again later
+                last_changes[id] = await _missing_since(id) or int(time.time())
+        for status in statuses[1:]:
+            metrics.CACHE_LOOKUPS.inc(status)
+
+    return last_changes, _combined_status(statuses)
+
+
+async def get_thread(
+    id: int,
+    since: int | None = None,
+    fields: list[str] | None = None,
+    client: str | None = None,
+) -> tuple[dict[str, str], str, str]:
     assert isinstance(id, int)
     name = NAME_FORMAT.format(id=id)
-    logger.debug(f"Last change {name}")
+    logger.debug(f"Get {name}")
+    _touch((id,))
+
+    status = await _maybe_update_thread_cache(id, name, client)
+    if status == STATUS_SHED:
+        return {}, status, ""
 
-    await _maybe_update_thread_cache(id, name)
+    thread = await _get_fields(name) or _missing_fields(status)
+    field_changes = thread.get(FIELD_CHANGES)
+    revision = _revision(thread)
+    thread = _public_fields(thread)
 
-    last_change = await redis.hget(name, LAST_CHANGE) or 0
-    return int(last_change)
+    # Only send fields that changed after since, if we know when they changed
+    if since is not None and field_changes:
+        field_changes = json.loads(field_changes)
+        thread = {
+            key: value
+            for key, value in thread.items()
+            if key == INDEX_ERROR or field_changes.get(key, since + 1) > since
+        }
+    if fields:
+        thread = {
+            key: value
+            for key, value in thread.items()
+            if key == INDEX_ERROR or key in fields
+        }
+    return thread, status, revision
 
 
-async def get_thread(id: int) -> dict[str, str]:
+async def get_thread_body(
+    id: int, encoding: str, client: str | None = None
+) -> tuple[bytes, str, str, str]:
     assert isinstance(id, int)
+    assert encoding in BODY_ENCODINGS
     name = NAME_FORMAT.format(id=id)
-    logger.debug(f"Get {name}")
+    body_name = BODY_FORMAT.format(id=id)
+    logger.debug(f"Get body {name} {encoding}")
+    _touch((id,))
 
-    await _maybe_update_thread_cache(id, name)
+    status = await _maybe_update_thread_cache(id, name, client)
+    if status == STATUS_SHED:
+        return b"", "", "", status
 
-    thread = await redis.hgetall(name)
+    if cached := hot_cache.get(("body", id, encoding)):
+        body, revision, index_error = cached
+        return body, revision, index_error, status
 
-    # Remove internal fields from response
-    for key in INTERNAL_KEYWORDS:
-        if key in thread:
-            del thread[key]
-    return thread
+    since = hot_cache.invalidations
+    body_fields = (BODY_REVISION, BODY_INDEX_ERROR, encoding)
+    revision, index_error, body = await redis_raw.hmget(body_name, body_fields)
 
+    if body is None:
+        # Cached before bodies were stored, serialize it once now
+        # Updates hold the lock too, so this can't overwrite a newer body
+        async with lock(id):
+            if not await redis_raw.exists(body_name):
+                if not (thread := await _get_fields(name)):
+                    # Nothing cached to keep a body for
+                    body = await _serialize_body(_missing_fields(status))
+                    return body[encoding], "", body[BODY_INDEX_ERROR], status
+                await redis_raw.hset(body_name, mapping=await _serialize_body(thread))
+        revision, index_error, body = await redis_raw.hmget(body_name, body_fields)
 
-async def _is_thread_cache_outdated(id: int, name: str) -> bool:
-    last_cached, expire_time = await redis.hmget(name, (LAST_CACHED, EXPIRE_TIME))
-    if last_cached and not expire_time:
-        expire_time = int(last_cached) + CACHE_TTL
-    # Never cached or cache expired
-    return not last_cached or time.time() >= int(expire_time)
+    revision, index_error = revision.decode(), index_error.decode()
+    hot_cache.put(
+        ("body", id, encoding), (body, revision, index_error), len(body), since
+    )
+    return body, revision, index_error, status
 
 
-async def _maybe_update_thread_cache(id: int, name: str) -> None:
-    # Check without lock first to avoid bottlenecks
-    if not await _is_thread_cache_outdated(id, name):
+async def changes_since(since: int, limit: int) -> tuple[dict[int, int], int | None]:
+    changes = await redis.zrangebyscore(
+        CHANGE_INDEX, f"({since}", "+inf", start=0, num=limit + 1, withscores=True
+    )
+    next_since = None
+
+    if len(changes) > limit:
+        # More pages, but don't split a single second across them
+        changes = changes[:limit]
+        last_second = changes[-1][1]
+        if changes[0][1] != last_second:
+            while changes[-1][1] == last_second:
+                changes.pop()
+        else:
+            changes = await redis.zrangebyscore(
+                CHANGE_INDEX, last_second, last_second, withscores=True
+            )
+        next_since = int(changes[-1][1])
+
+    return {int(id): int(last_change) for id, last_change in changes}, next_since
+
+
+async def expire_report() -> dict[str, float]:
+    learned, fixed = await redis.hmget(EXPIRE_STATS, ("learned", "fixed"))
+    learned = float(learned or 0)
+    fixed = float(fixed or 0)
+    return {
+        "scrapes_per_day": learned,
+        "fixed_scrapes_per_day": fixed,
+        "savings": 1 - learned / fixed if fixed else 0.0,
+    }
+
+
+async def refresh_thread(id: int) -> None:
+    assert isinstance(id, int)
+    name = NAME_FORMAT.format(id=id)
+    logger.debug(f"Refresh {name}")
+
+    if not await redis.exists(name):
+        # Thread is gone, drop its leftover index entry
+        await redis.zrem(EXPIRE_INDEX, id)
         return
 
+    if jobs.enabled:
+        await jobs.run(id)
+    else:
+        await scrape_thread(id)
+
+
+async def scrape_thread(id: int) -> None:
+    name = NAME_FORMAT.format(id=id)
     # If it might be outdated, check with lock to avoid multiple updates
     async with lock(id):
         if await _is_thread_cache_outdated(id, name):
             await _update_thread_cache(id, name)
 
 
+def expire_score(last_cached: str | None, expire_time: str | None) -> int:
+    # Invalidated threads are due right away
+    if not last_cached:
+        return 0
+    if not expire_time:
+        expire_time = int(last_cached) + CACHE_TTL
+    return int(expire_time)
+
+
+async def build_indexes() -> None:
+    missing = [
+        index
+        for index in (EXPIRE_INDEX, CHANGE_INDEX, ACCESS_INDEX)
+        if not await redis.exists(index)
+    ]
+    if not missing:
+        return
+    logger.info(f"Build indexes {', '.join(missing)} start")
+
+    async def add_chunk(names: list[str]):
+        cached_data = redis.pipeline()
+        for name in names:
+            cached_data.hmget(name, LAST_CACHED, EXPIRE_TIME, LAST_CHANGE)
+        cached_data = await cached_data.execute()
+        ids = [name.split(":")[1] for name in names]
+        index_data = redis.pipeline()
+        if EXPIRE_INDEX in missing:
+            index_data.zadd(
+                EXPIRE_INDEX,
+                {
+                    id: expire_score(last_cached, expire_time)
+                    for id, (last_cached, expire_time, _) in zip(ids, cached_data)
+                },
+            )
+        if CHANGE_INDEX in missing:
+            index_data.zadd(
+                CHANGE_INDEX,
+                {
+                    id: int(last_change)
+                    for id, (_, _, last_change) in zip(ids, cached_data)
+                    if last_change
+                },
+            )
+        if ACCESS_INDEX in missing:
+            # Access wasn't tracked before, so start counting from now
+            index_data.zadd(ACCESS_INDEX, {id: int(time.time()) for id in ids})
+        await index_data.execute()
+
+    names = []
+    indexed = 0
+    try:
+        async for name in redis.scan_iter("thread:*", 10000, "hash"):
+            names.append(name)
+            if len(names) >= BUILD_INDEXES_CHUNK_SIZE:
+                await add_chunk(names)
+                indexed += len(names)
+                names.clear()
+        if names:
+            await add_chunk(names)
+            indexed += len(names)
+    except Exception:
+        logger.error(f"Error building indexes: {error.text()}\n{error.traceback()}")
+        return
+
+    logger.info(f"Build indexes done ({indexed} threads)")
+
+
+async def migrate_codec() -> None:
+    # Train a dictionary on cached threads, then repack all of them with it
+    samples = []
+    async for name in redis.scan_iter("thread:*", 10000, "hash"):
+        fields = await _get_fields(name)
+        if any(key in fields for key in PACKED_FIELDS):
+            samples.append(_packed_payload(fields))
+        if len(samples) >= CODEC_TRAIN_SAMPLES:
+            break
+
+    if len(samples) >= CODEC_TRAIN_MIN_SAMPLES:
+        dictionary = await asyncio.to_thread(
+            zstandard.train_dictionary, CODEC_DICT_SIZE, samples, level=CODEC_LEVEL
+        )
+        dict_id = dictionary.dict_id()
+        await redis_raw.hset(
+            CODEC_DICTS,
+            mapping={dict_id: dictionary.as_bytes(), CODEC_CURRENT: dict_id},
+        )
+        await _load_codec_dicts()
+        logger.info(f"Codec dictionary {dict_id} trained on {len(samples)} threads")
+    else:
+        logger.warning(
+            f"Only {len(samples)} threads to train on, packing without dictionary"
+        )
+    _benchmark_codec(samples)
+
+    migrated = 0
+    before = 0
+    after = 0
+    bodies = 0
+
+    async def migrate_chunk(names: list[str]):
+        nonlocal migrated, before, after, bodies
+        # Stored bodies aren't packed, but count them so the total is honest
+        memory_data = redis.pipeline()
+        for name in names:
+            memory_data.memory_usage(name)
+            memory_data.memory_usage(BODY_FORMAT.format(id=name.split(":")[1]))
+        sizes = [size or 0 for size in await memory_data.execute()]
+        before += sum(sizes[::2])
+        bodies += sum(sizes[1::2])
+
+        migrate_data = redis_raw.pipeline()
+        for name in names:
+            fields = await _get_fields(name)
+            packed = {key: fields[key] for key in PACKED_FIELDS if key in fields}
+            if not packed:
+                continue
+            migrate_data.eval(
+                CODEC_MIGRATE_SCRIPT,
+                1,
+                name,
+                LAST_CACHED,
+                fields.get(LAST_CACHED, ""),
+                PACKED,
+                _pack(packed),
+                *PACKED_FIELDS,
+            )
+        migrated += sum(await migrate_data.execute())
+
+        memory_data = redis.pipeline()
+        for name in names:
+            memory_data.memory_usage(name)
+        after += sum(size or 0 for size in await memory_data.execute())
+
+    names = []
+    async for name in redis.scan_iter("thread:*", 10000, "hash"):
+        names.append(name)
+        if len(names) >= CODEC_MIGRATE_CHUNK_SIZE:
+            await migrate_chunk(names)
+            names.clear()
+    if names:
+        await migrate_chunk(names)
+
+    logger.info(
+        f"Codec migrated {migrated} threads, memory {before / 1024 / 1024:.1f} MiB"
+        f" -> {after / 1024 / 1024:.1f} MiB, plus {bodies / 1024 / 1024:.1f} MiB"
+        f" of stored bodies, total {(before + bodies) / 1024 / 1024:.1f} MiB"
+        f" -> {(after + bodies) / 1024 / 1024:.1f} MiB"
+    )
+    if not pack_fields:
+        logger.warning("PACK_FIELDS is disabled, threads will be unpacked as scraped")
+
+
+def _touch(ids: list[int]) -> None:
+    now = int(time.time())
+    for id in ids:
+        accessed[id] = now
+
+
+async def _flush_accessed() -> None:
+    if not accessed:
+        return
+    mapping = dict(accessed)
+    accessed.clear()
+    # Other workers may have saved a later access already
+    await redis.zadd(ACCESS_INDEX, mapping, gt=True)
+
+
+async def _load_codec_dicts() -> None:
+    global codec_compressor
+    # Frames without a dictionary ID were packed before one was trained
+    codec_compressor = zstandard.ZstdCompressor(level=CODEC_LEVEL)
+    codec_decompressors[0] = zstandard.ZstdDecompressor()
+    dicts = await redis_raw.hgetall(CODEC_DICTS)
+    current = dicts.pop(CODEC_CURRENT.encode(), None)
+    for dict_id, dict_data in dicts.items():
+        dictionary = zstandard.ZstdCompressionDict(dict_data)
+        codec_dicts[int(dict_id)] = dictionary
+        codec_decompressors[int(dict_id)] = zstandard.ZstdDecompressor(
+            dict_data=dictionary
+        )
+    if current:
+        codec_compressor = zstandard.ZstdCompressor(
+            level=CODEC_LEVEL, dict_data=codec_dicts[int(current)]
+        )
+
+
+async def _get_fields(name: str) -> dict[str, str]:
+    # Read with the binary client, as packed fields aren't text
+    fields = {
+        key.decode(): value for key, value in (await redis_raw.hgetall(name)).items()
+    }
+    packed = fields.pop(PACKED, None)
+    fields = {key: value.decode() for key, value in fields.items()}
+    if packed:
+        fields.update(await _unpack(packed))
+    return fields
+
+
+def _pack_fields(
+    pipeline: aredis.client.Pipeline, name: str, new_fields: dict[str, str]
+) -> None:
+    # Leaves new_fields with what to store as hash fields
+    if pack_fields:
+        packed = {
+            key: new_fields.pop(key) for key in PACKED_FIELDS if key in new_fields
+        }
+        new_fields[PACKED] = _pack(packed)
+        pipeline.hdel(name, *PACKED_FIELDS)
+    else:
+        pipeline.hdel(name, PACKED)
+
+
+def _packed_payload(fields: dict[str, str]) -> bytes:
+    return json.dumps(
+        {key: fields[key] for key in PACKED_FIELDS if key in fields},
+        ensure_ascii=False,
+        separators=(",", ":"),
+    ).encode()
+
+
+def _pack(fields: dict[str, str]) -> bytes:
+    # Frame header has the dictionary ID, so older dictionaries stay readable
+    return codec_compressor.compress(_packed_payload(fields))
+
+
+async def _unpack(packed: bytes) -> dict[str, str]:
+    dict_id = zstandard.get_frame_parameters(packed).dict_id
+    if dict_id not in codec_decompressors:
+        # Trained by another process since we loaded them
+        await _load_codec_dicts()
+    return json.loads(codec_decompressors[dict_id].decompress(packed))
+
+
+def _benchmark_codec(samples: list[bytes]) -> None:
+    if not samples:
+        return
+    raw = sum(len(sample) for sample in samples)
+    start = time.perf_counter()
+    packed = [codec_compressor.compress(sample) for sample in samples]
+    pack_time = time.perf_counter() - start
+    decompressor = codec_decompressors[
+        zstandard.get_frame_parameters(packed[0]).dict_id
+    ]
+    start = time.perf_counter()
+    for blob in packed:
+        json.loads(decompressor.decompress(blob))
+    unpack_time = time.perf_counter() - start
+    size = sum(len(blob) for blob in packed)
+    logger.info(
+        f"Codec benchmark on {len(samples)} threads: {raw / len(samples):.0f} ->"
+        f" {size / len(samples):.0f} bytes ({size / raw:.1%}),"
+        f" pack {pack_time / len(samples) * 1e6:.0f}us,"
+        f" unpack {unpack_time / len(samples) * 1e6:.0f}us"
+    )
+
+
+def _revision(thread: dict[str, str]) -> str:
+    # Changes whenever the stored data does, for use in validators
+    return "-".join(
+        thread.get(key, "") for key in (LAST_CHANGE, LAST_CACHED, CACHED_WITH)
+    )
+
+
+def _public_fields(thread: dict[str, str]) -> dict[str, str]:
+    # Remove internal fields from response
+    return {key: value for key, value in thread.items() if key not in INTERNAL_KEYWORDS}
+
+
+async def _serialize_body(thread: dict[str, str]) -> dict[str, bytes]:
+    # Same format as JSONResponse, but serialized and compressed once per scrape
+    body = json.dumps(
+        _public_fields(thread),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode()
+    gzip_body, zstd_body = await asyncio.gather(
+        asyncio.to_thread(gzip.compress, body, BODY_GZIP_LEVEL),
+        asyncio.to_thread(zstandard.compress, body, BODY_ZSTD_LEVEL),
+    )
+    return {
+        BODY_REVISION: _revision(thread),
+        BODY_INDEX_ERROR: thread.get(INDEX_ERROR, ""),
+        BODY_IDENTITY: body,
+        BODY_GZIP: gzip_body,
+        BODY_ZSTD: zstd_body,
+    }
+
+
+def _change_history(old_fields: dict[str, str], now: float) -> str:
+    # Recent change times, seeded with the last one from before tracking them
+    history = json.loads(old_fields.get(CHANGE_HISTORY) or "[]")
+    field_changes = json.loads(old_fields.get(FIELD_CHANGES) or "{}")
+    if not history and (
+        last_change := max(
+            (field_changes.get(key, 0) for key in EXPIRE_HISTORY_FIELDS),
+            default=0,
+        )
+        or old_fields.get(LAST_CHANGE)
+    ):
+        history.append(int(last_change))
+    history.append(int(now))
+    return json.dumps(history[-EXPIRE_HISTORY_SIZE:])
+
+
+def _expire_ttl(thread: dict[str, str], short: bool, now: float) -> tuple[float, float]:
+    # Scrape at a share of the usual time between changes, or of how long it has
+    # been quiet if longer, returns that and the fixed TTL it replaces
+    fixed_ttl = SHORT_TTL if short else CACHE_TTL
+    history = json.loads(thread.get(CHANGE_HISTORY) or "[]")
+    intervals = [later - earlier for earlier, later in zip(history, history[1:])]
+    if intervals:
+        usual = statistics.median(intervals)
+    else:
+        usual = fixed_ttl / EXPIRE_CHANGE_SHARE
+    quiet = now - int(history[-1] if history else thread.get(LAST_CHANGE) or now)
+
+    try:
+        status = Status(int(thread.get("status") or Status.Normal))
+    except ValueError:
+        status = Status.Normal
+    low, high = EXPIRE_BOUNDS.get(status, EXPIRE_BOUNDS[Status.Normal])
+    if short:
+        # Version is only in the thread, watchers won't notice updates
+        high = min(high, SHORT_TTL)
+        low = min(low, high)
+
+    ttl = max(usual, quiet) * EXPIRE_CHANGE_SHARE
+    return min(max(ttl, low), high), fixed_ttl
+
+
+def _track_expire_policy(
+    pipeline: aredis.client.Pipeline,
+    old_fields: dict[str, str],
+    ttl: float,
+    fixed_ttl: float,
+) -> str:
+    # Keep totals of scrapes per day with learned and fixed TTLs for the report
+    day = dt.timedelta(days=1).total_seconds()
+    old_ttl, old_fixed_ttl = json.loads(old_fields.get(EXPIRE_POLICY) or "[0, 0]")
+    pipeline.hincrbyfloat(
+        EXPIRE_STATS, "learned", day / ttl - (day / old_ttl if old_ttl else 0)
+    )
+    pipeline.hincrbyfloat(
+        EXPIRE_STATS,
+        "fixed",
+        day / fixed_ttl - (day / old_fixed_ttl if old_fixed_ttl else 0),
+    )
+    return json.dumps([ttl, fixed_ttl])
+
+
+def _combined_status(statuses: list[str]) -> str:
+    # Any stale data in the response is the most important to report
+    for status in (STATUS_SHED, STATUS_STALE, STATUS_SCRAPED):
+        if status in statuses:
+            return status
+    return STATUS_FRESH
+
+
+def _is_outdated(last_cached: str | None, expire_time: str | None) -> bool:
+    # Never cached or cache expired
+    return time.time() >= expire_score(last_cached, expire_time)
+
+
+async def _is_thread_cache_outdated(id: int, name: str) -> bool:
+    last_cached, expire_time = await redis.hmget(name, (LAST_CACHED, EXPIRE_TIME))
+    return _is_outdated(last_cached, expire_time)
+
+
+async def _maybe_update_thread_cache(
+    id: int, name: str, client: str | None = None
+) -> str:
+    # Check without lock first to avoid bottlenecks
+    if not (cached := hot_cache.get(("meta", id))):
+        since = hot_cache.invalidations
+        cached = tuple(await redis.hmget(name, (LAST_CACHED, EXPIRE_TIME, LAST_CHANGE)))
+        hot_cache.put(("meta", id), cached, 0, since)
+    last_cached, expire_time, last_change = cached
+    if not _is_outdated(last_cached, expire_time):
+        status = STATUS_FRESH
+    else:
+        status = await _refresh_thread_cache(id, name, bool(last_change), client)
+    metrics.CACHE_LOOKUPS.inc(status)
+    return status
+
+
+async def _refresh_thread_cache(
+    id: int, name: str, cached: bool, client: str | None = None
+) -> str:
+    # Known to be missing, no need to ask F95zone again yet
+    if not cached and await _missing_since(id):
+        return STATUS_FRESH
+
+    # Clients that caused too many scrapes get what we have, or nothing
+    if await _admit(client):
+        logger.warning(f"Shed scrape of {name} for {client}")
+        return STATUS_STALE if cached else STATUS_SHED
+
+    # Serve what we have and scrape in background, only never cached threads wait
+    if stale_while_revalidate and cached:
+        if jobs.enabled:
+            await jobs.enqueue(id)
+        elif id not in revalidating:
+            task = asyncio.create_task(_revalidate_thread_cache(id, name))
+            task.add_done_callback(lambda _: revalidating.pop(id, None))
+            revalidating[id] = task
+        return STATUS_STALE
+
+    if jobs.enabled:
+        scraped = await jobs.run(id)
+        # Don't wait for the invalidation message to come back from Redis
+        hot_cache.invalidate(id)
+        if not scraped:
+            logger.warning(f"Scrape of {name} failed or timed out")
+            return STATUS_STALE
+    else:
+        await scrape_thread(id)
+    return STATUS_SCRAPED
+
+
+async def _revalidate_thread_cache(id: int, name: str) -> None:
+    try:
+        await scrape_thread(id)
+    except Exception:
+        logger.error(
+            f"Exception revalidating {name}: {error.text()}\n{error.traceback()}"
+        )
+
+
+async def _missing_since(id: int) -> int:
+    # Start of the generation it was found missing in, 0 if not known missing
+    generation = int(time.time() // MISSING_GENERATION)
+    missing_data = redis.pipeline()
+    missing_data.getbit(MISSING_FORMAT.format(generation=generation), id)
+    missing_data.getbit(MISSING_FORMAT.format(generation=generation - 1), id)
+    missing_data.zscore(TOP_ID_INDEX, TOP_ID_MEMBER)
+    missing, previously_missing, top_id = await missing_data.execute()
+    if missing or (top_id is not None and id > top_id + TOP_ID_MARGIN):
+        return int(generation * MISSING_GENERATION)
+    if previously_missing:
+        return int((generation - 1) * MISSING_GENERATION)
+    return 0
+
+
+async def _admit(client: str | None) -> float:
+    # Returns 0 if the client may cause another scrape, seconds to wait otherwise
+    if not client or not admission_scrapes:
+        return 0
+    return await distributed.Limiter(
+        ADMISSION_FORMAT.format(client=client), admission_scrapes, ADMISSION_PERIOD
+    ).try_acquire()
+
+
+def _missing_fields(status: str) -> dict[str, str]:
+    # Without a thread hash, it was either found missing or the scrape timed out
+    if status == STATUS_STALE:
+        return {INDEX_ERROR: f95zone.ERROR_F95ZONE_UNAVAILABLE.error_flag}
+    return {INDEX_ERROR: f95zone.ERROR_THREAD_MISSING.error_flag}
+
+
 async def _update_thread_cache(id: int, name: str) -> None:
     logger.info(f"Update cached {name}")
 
+    # Validators and digests from the last good scrape, to skip unchanged pages
+    scrape_state, index_error = await redis.hmget(name, (SCRAPE_STATE, INDEX_ERROR))
+    scrape_state = json.loads(scrape_state or "{}")
+    if index_error:
+        # Validators may be from a bad response, how far reviews got is still right
+        scrape_state = {
+            key: value
+            for key, value in scrape_state.items()
+            if key in scraper.REVIEWS_PROGRESS
+        }
+
+    start = time.perf_counter()
     try:
-        result = await scraper.thread(id)
+        result = await scraper.thread(id, scrape_state)
     except Exception:
         logger.error(f"Exception caching {name}: {error.text()}\n{error.traceback()}")
         result = f95zone.ERROR_INTERNAL_ERROR
-    old_fields = await redis.hgetall(name)
+    if isinstance(result, f95zone.IndexerError):
+        outcome = result.error_flag
+    else:
+        outcome = "unchanged" if result == scraper.UNCHANGED else "parsed"
+    metrics.SCRAPE_SECONDS.observe(time.perf_counter() - start, outcome)
+    old_fields = await _get_fields(name)
     now = time.time()
 
+    if result == f95zone.ERROR_THREAD_MISSING and "name" not in old_fields:
+        # Never had any data, a bit is enough to remember it's missing
+        generation = int(now // MISSING_GENERATION)
+        missing_name = MISSING_FORMAT.format(generation=generation)
+        cache_data = redis.pipeline()
+        cache_data.setbit(missing_name, id, 1)
+        cache_data.expire(missing_name, int(MISSING_GENERATION * 2))
+        cache_data.delete(name, BODY_FORMAT.format(id=id))
+        cache_data.zrem(EXPIRE_INDEX, id)
+        cache_data.zrem(CHANGE_INDEX, id)
+        invalidate(cache_data, id)
+        await cache_data.execute()
+        hot_cache.invalidate(id)
+        logger.info(f"Thread {name} missing")
+        return
+
+    if result == scraper.UNCHANGED:
+        # Nothing to parse, but the body has the new cache times and revision too
+        ttl, fixed_ttl = _expire_ttl(old_fields, scrape_state.get("short_ttl"), now)
+        cache_data = redis_raw.pipeline()
+        new_fields = {
+            EXPIRE_TIME: int(now + ttl),
+            EXPIRE_POLICY: _track_expire_policy(cache_data, old_fields, ttl, fixed_ttl),
+            LAST_CACHED: int(now),
+            SCRAPE_STATE: json.dumps(scrape_state),
+        }
+        thread = {
+            **old_fields,
+            **{key: str(value) for key, value in new_fields.items()},
+        }
+        cache_data.hset(name, mapping=new_fields)
+        cache_data.hset(
+            BODY_FORMAT.format(id=id), mapping=await _serialize_body(thread)
+        )
+        cache_data.zadd(EXPIRE_INDEX, {id: new_fields[EXPIRE_TIME]})
+        invalidate(cache_data, id)
+        await cache_data.execute()
+        hot_cache.invalidate(id)
+        logger.info(f"Data for {name} unchanged")
+        return
+
     if isinstance(result, f95zone.IndexerError):
         # Something went wrong, keep cache and retry sooner/later
+        new_reviews = []
         new_fields = {
             INDEX_ERROR: result.error_flag,
             EXPIRE_TIME: int(now + result.retry_delay),
         }
         # Consider new error as a change
+        changed_fields = []
         if old_fields.get(INDEX_ERROR) != new_fields.get(INDEX_ERROR):
+            changed_fields.append(INDEX_ERROR)
             new_fields[LAST_CHANGE] = int(now)
     else:
         # F95zone responded, cache new thread data
         new_fields = {
             **result,
             INDEX_ERROR: "",
-            EXPIRE_TIME: int(now + CACHE_TTL),
         }
+        new_reviews = new_fields.pop(scraper.NEW_REVIEWS)
         # Recache more often if using thread_version
+        scrape_state["short_ttl"] = "thread_version" in new_fields
         if "thread_version" in new_fields:
             del new_fields["thread_version"]
-            new_fields[EXPIRE_TIME] = int(now + SHORT_TTL)
+        new_fields[SCRAPE_STATE] = json.dumps(scrape_state)
         # Track last time that some meaningful data changed to tell clients to full check it
-        if any(
-            new_fields.get(key) != old_fields.get(key)
+        changed_fields = [
+            key
             for key in LAST_CHANGE_ELIGIBLE_FIELDS
-        ):
+            if new_fields.get(key) != old_fields.get(key)
+        ]
+        if changed_fields:
             new_fields[LAST_CHANGE] = int(now)
             logger.info(f"Data for {name} changed")
+        if any(key in changed_fields for key in EXPIRE_HISTORY_FIELDS):
+            new_fields[CHANGE_HISTORY] = _change_history(old_fields, now)
+
+    # Also track when each field last changed, so clients can fetch only those
+    # Fields without history are assumed to have changed with the last change
+    field_changes = json.loads(old_fields.get(FIELD_CHANGES) or "{}")
+    for key in LAST_CHANGE_ELIGIBLE_FIELDS:
+        if key in changed_fields:
+            field_changes[key] = int(now)
+        else:
+            field_changes.setdefault(key, int(old_fields.get(LAST_CHANGE) or now))
+    new_fields[FIELD_CHANGES] = json.dumps(field_changes)
 
     new_fields[LAST_CACHED] = int(now)
     new_fields[CACHED_WITH] = meta.version
     if LAST_CHANGE not in old_fields and LAST_CHANGE not in new_fields:
         new_fields[LAST_CHANGE] = int(now)
-    await redis.hmset(name, new_fields)
+    cache_data = redis_raw.pipeline()
+    if not isinstance(result, f95zone.IndexerError):
+        ttl, fixed_ttl = _expire_ttl(
+            {**old_fields, **new_fields}, scrape_state["short_ttl"], now
+        )
+        new_fields[EXPIRE_TIME] = int(now + ttl)
+        new_fields[EXPIRE_POLICY] = _track_expire_policy(
+            cache_data, old_fields, ttl, fixed_ttl
+        )
+    thread = {**old_fields, **{key: str(value) for key, value in new_fields.items()}}
+    body = await _serialize_body(thread)
+    if not isinstance(result, f95zone.IndexerError):
+        # Errors keep the old fields, packed or not
+        _pack_fields(cache_data, name, new_fields)
+        cache_data.zadd(TOP_ID_INDEX, {TOP_ID_MEMBER: id}, gt=True)
+    cache_data.hmset(name, new_fields)
+    # Ready to send response body for /full
+    cache_data.hset(BODY_FORMAT.format(id=id), mapping=body)
+    # Tell the refresh scheduler when this thread will be due again
+    cache_data.zadd(EXPIRE_INDEX, {id: new_fields[EXPIRE_TIME]})
+    # Reviews one by one, including older ones than fit in the thread
+    reviews.store(cache_data, id, new_reviews)
+    # Feed for clients syncing their library with /changes
+    if LAST_CHANGE in new_fields:
+        cache_data.zadd(CHANGE_INDEX, {id: new_fields[LAST_CHANGE]})
+    invalidate(cache_data, id)
+    await cache_data.execute()
+    hot_cache.invalidate(id)
@@ -0,0 +1,247 @@
+import asyncio
+import contextlib
+import logging
+import secrets
+import time
+
+import redis.asyncio as aredis
+
+from indexer import metrics
+
+LOCK_FORMAT = "lock:{name}"
+LOCK_LEASE = 30.0
+LOCK_RETRY_MIN = 0.05
+LOCK_RETRY_MAX = 1.0
+CLAIM_FORMAT = "claim:{name}"
+LIMITER_FORMAT = "limiter:{name}"
+LIMITER_STATE_TTL = 3600.0
+LIMITER_INCREASE_STEP = 0.01
+LIMITER_DECREASE_FACTOR = 0.5
+LIMITER_DECREASE_COOLDOWN = 2.0
+
+# Only release or renew a lock if we still own it
+RELEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+RENEW_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+# Token bucket refilling rate tokens every time_period, returns ms to wait
+# Rate can be adjusted at runtime by ADJUST_SCRIPT, and paused for backoff
+TOKEN_BUCKET_SCRIPT = """
+local period = tonumber(ARGV[2])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + tonumber(time[2]) / 1000
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated", "rate", "paused_until")
+local rate = tonumber(state[3]) or tonumber(ARGV[1])
+local paused_until = tonumber(state[4]) or 0
+if now < paused_until then
+    return math.ceil(paused_until - now)
+end
+local capacity = math.max(1, rate)
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate / period)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) * period / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+redis.call("PEXPIRE", KEYS[1], ARGV[3])
+return math.ceil(wait)
+"""
+# Additive increase, or multiplicative decrease at most once per cooldown
+ADJUST_SCRIPT = """
+local floor_rate = tonumber(ARGV[2])
+local ceiling_rate = tonumber(ARGV[3])
+local step = tonumber(ARGV[4])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + tonumber(time[2]) / 1000
+local state = redis.call("HMGET", KEYS[1], "rate", "decreased")
+local rate = tonumber(state[1]) or tonumber(ARGV[1])
+if step > 0 then
+    rate = math.min(ceiling_rate, rate + step)
+elseif now - (tonumber(state[2]) or 0) >= tonumber(ARGV[6]) then
+    rate = math.max(floor_rate, rate * tonumber(ARGV[5]))
+    redis.call("HSET", KEYS[1], "decreased", tostring(now))
+    local pause = tonumber(ARGV[7])
+    if pause > 0 then
+        redis.call("HSET", KEYS[1], "paused_until", tostring(now + pause))
+    end
+end
+redis.call("HSET", KEYS[1], "rate", tostring(rate))
+redis.call("PEXPIRE", KEYS[1], ARGV[8])
+return tostring(rate)
+"""
+
+logger = logging.getLogger(__name__)
+redis: aredis.Redis = None
+
+
+@contextlib.asynccontextmanager
+async def lifespan():
+    global redis
+    redis = metrics.redis_client(decode_responses=True)
+    await redis.ping()
+
+    try:
+        yield
+    finally:
+
+        await redis.aclose()
+        redis = None
+
+
+# https://redis.io/docs/latest/develop/use/patterns/distributed-locks/
+@contextlib.asynccontextmanager
+async def lock(name: str, lease: float = LOCK_LEASE):
+    key = LOCK_FORMAT.format(name=name)
+    token = secrets.token_hex(16)
+    retry = LOCK_RETRY_MIN
+    while not await redis.set(key, token, nx=True, px=int(lease * 1000)):
+        await asyncio.sleep(retry)
+        retry = min(retry * 2, LOCK_RETRY_MAX)
+
+    # Keep the lease alive while we hold it, it expires by itself if we die
+    async def renew():
+        while True:
+            await asyncio.sleep(lease / 3)
+            if not await redis.eval(RENEW_SCRIPT, 1, key, token, int(lease * 1000)):
+                logger.warning(f"Lost lease on {key}")
+                return
+
+    renew_task = asyncio.create_task(renew())
+    try:
+        yield
+    finally:
+
+        renew_task.cancel()
+        await redis.eval(RELEASE_SCRIPT, 1, key, token)
+
+
+async def claim(name: str, duration: float) -> float:
+    # Returns 0 if claimed, otherwise seconds until someone else's claim runs out
+    key = CLAIM_FORMAT.format(name=name)
+    if await redis.set(key, 1, nx=True, px=int(duration * 1000)):
+        return 0
+    remaining = await redis.pttl(key)
+    return max(remaining, 0) / 1000 or LOCK_RETRY_MIN
+
+
+async def reclaim(name: str, duration: float) -> None:
+    # Replace the current claim, like for retrying sooner after errors
+    await redis.set(CLAIM_FORMAT.format(name=name), 1, px=int(duration * 1000))
+
+
+class Limiter:
+    __slots__ = (
+        "name",
+        "max_rate",
+        "time_period",
+    )
+
+    def __init__(self, name: str, max_rate: float, time_period: float):
+        self.name = name
+        self.max_rate = max_rate
+        self.time_period = time_period
+
+    async def acquire(self) -> None:
+        start = time.perf_counter()
+        metrics.LIMITER_WAITING.inc(self.name)
+        try:
+            while wait := await self.try_acquire():
+                await asyncio.sleep(wait)
+        finally:
+            metrics.LIMITER_WAITING.dec(self.name)
+            metrics.LIMITER_WAIT_SECONDS.observe(time.perf_counter() - start, self.name)
+
+    async def try_acquire(self) -> float:
+        # Returns 0 if allowed, otherwise seconds until it would be
+        wait = await redis.eval(
+            TOKEN_BUCKET_SCRIPT,
+            1,
+            LIMITER_FORMAT.format(name=self.name),
+            self.max_rate,
+            int(self.time_period * 1000),
+            int(LIMITER_STATE_TTL * 1000),
+        )
+        return wait / 1000
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+# https://en.wikipedia.org/wiki/Additive_increase/multiplicative_decrease
+class AdaptiveLimiter(Limiter):
+    # Starts at max_rate, then moves between floor_rate and ceiling_rate
+    __slots__ = (
+        "floor_rate",
+        "ceiling_rate",
+        "increase_step",
+        "decrease_factor",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        max_rate: float,
+        time_period: float,
+        floor_rate: float,
+        ceiling_rate: float,
+        increase_step: float = LIMITER_INCREASE_STEP,
+        decrease_factor: float = LIMITER_DECREASE_FACTOR,
+    ):
+        super().__init__(name, max_rate, time_period)
+        self.floor_rate = floor_rate
+        self.ceiling_rate = ceiling_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+
+    async def increase(self) -> float:
+        return await self._adjust(self.increase_step, pause=0)
+
+    async def decrease(self, pause: float = 0) -> float:
+        # Pausing stops all requests for a while, like after hitting a ratelimit
+        return await self._adjust(0, pause)
+
+    async def state(self) -> dict[str, float]:
+        rate, paused_until, decreased = await redis.hmget(
+            LIMITER_FORMAT.format(name=self.name), "rate", "paused_until", "decreased"
+        )
+        rate = float(rate or self.max_rate)
+        now = time.time() * 1000
+        return {
+            "rate": rate,
+            "requests_per_second": rate / self.time_period,
+            "floor_rate": self.floor_rate,
+            "ceiling_rate": self.ceiling_rate,
+            "paused_for": max(0, float(paused_until or 0) - now) / 1000,
+            "last_decrease": float(decreased or 0) / 1000,
+        }
+
+    async def _adjust(self, step: float, pause: float) -> float:
+        rate = await redis.eval(
+            ADJUST_SCRIPT,
+            1,
+            LIMITER_FORMAT.format(name=self.name),
+            self.max_rate,
+            self.floor_rate,
+            self.ceiling_rate,
+            step,
+            self.decrease_factor,
+            int(LIMITER_DECREASE_COOLDOWN * 1000),
+            int(pause * 1000),
+            int(LIMITER_STATE_TTL * 1000),
+        )
+        return float(rate)
@@ -0,0 +1,161 @@
+import asyncio
+import contextlib
+import datetime as dt
+import logging
+import os
+import time
+
+from external import error
+from indexer import (
+    cache,
+    distributed,
+    reviews,
+)
+
+EVICT_DEFAULT_DAYS = 90
+EVICT_INTERVAL = dt.timedelta(hours=6).total_seconds()
+EVICT_CHUNK_SIZE = 1000
+EVICT_STATS = "stats:evict"
+# Only evict if still unused, it may have been requested since it was listed
+EVICT_SCRIPT = """
+local accessed = redis.call("ZSCORE", KEYS[1], ARGV[1])
+if not accessed or tonumber(accessed) > tonumber(ARGV[2]) then
+    return 0
+end
+redis.call("ZREM", KEYS[1], ARGV[1])
+redis.call("ZREM", KEYS[2], ARGV[1])
+redis.call("ZREM", KEYS[3], ARGV[1])
+-- Evicted threads aren't scraped anymore, take them out of the expire report
+local policy = redis.call("HGET", KEYS[4], ARGV[3])
+if policy then
+    local ttls = cjson.decode(policy)
+    local day = tonumber(ARGV[4])
+    if ttls[1] > 0 then
+        redis.call("HINCRBYFLOAT", KEYS[8], "learned", -day / ttls[1])
+    end
+    if ttls[2] > 0 then
+        redis.call("HINCRBYFLOAT", KEYS[8], "fixed", -day / ttls[2])
+    end
+end
+return redis.call("DEL", KEYS[4], KEYS[5], KEYS[6], KEYS[7])
+"""
+
+logger = logging.getLogger(__name__)
+
+
+@contextlib.asynccontextmanager
+async def lifespan():
+    days = float(os.environ.get("EVICT_UNUSED_DAYS") or EVICT_DEFAULT_DAYS)
+    evict_task = None
+    if days > 0:
+        evict_task = asyncio.create_task(
+            evict_unused(dt.timedelta(days=days).total_seconds())
+        )
+
+    try:
+        yield
+    finally:
+
+        if evict_task:
+            evict_task.cancel()
+
+
+async def evict_unused(window: float):
+    await asyncio.sleep(60)
+
+    while True:
+        try:
+            # Only one worker evicts in each interval
+            if wait := await distributed.claim("evict_unused", EVICT_INTERVAL):
+                await asyncio.sleep(wait)
+                continue
+
+            logger.info("Evict unused threads start")
+            evicted, reclaimed = await evict_pass(time.time() - window)
+            logger.info(
+                f"Evict unused threads done ({evicted} threads, {reclaimed / 1024 / 1024:.1f} MiB)"
+            )
+
+        except Exception:
+            logger.error(
+                f"Error evicting unused threads: {error.text()}\n{error.traceback()}"
+            )
+
+        await asyncio.sleep(EVICT_INTERVAL)
+
+
+async def evict_pass(cutoff: float) -> tuple[int, int]:
+    # Drop threads nobody requested since cutoff, so watchers stop checking them
+    # and they get scraped fresh if someone asks again
+    evicted = 0
+    reclaimed = 0
+    while True:
+        ids = await cache.redis.zrangebyscore(
+            cache.ACCESS_INDEX, "-inf", cutoff, start=0, num=EVICT_CHUNK_SIZE
+        )
+        if not ids:
+            break
+
+        keys = {id: _keys(id) for id in ids}
+        usage_data = cache.redis.pipeline()
+        for id in ids:
+            for key in keys[id]:
+                usage_data.memory_usage(key)
+        usage_data = await usage_data.execute()
+
+        evict_data = cache.redis.pipeline()
+        for id in ids:
+            evict_data.eval(
+                EVICT_SCRIPT,
+                8,
+                cache.ACCESS_INDEX,
+                cache.EXPIRE_INDEX,
+                cache.CHANGE_INDEX,
+                *keys[id],
+                cache.EXPIRE_STATS,
+                id,
+                int(cutoff),
+                cache.EXPIRE_POLICY,
+                int(dt.timedelta(days=1).total_seconds()),
+            )
+            cache.invalidate(evict_data, id)
+        evict_data = await evict_data.execute()
+
+        # Only count EVAL results, skip publish
+        for index, deleted in enumerate(evict_data[::2]):
+            if not deleted:
+                continue
+            evicted += 1
+            usage = usage_data[index * 4 : (index + 1) * 4]
+            reclaimed += sum(size or 0 for size in usage)
+
+    stats_data = cache.redis.pipeline()
+    stats_data.hincrby(EVICT_STATS, "threads", evicted)
+    stats_data.hincrby(EVICT_STATS, "bytes", reclaimed)
+    stats_data.hset(
+        EVICT_STATS,
+        mapping={
+            "last_threads": evicted,
+            "last_bytes": reclaimed,
+            "last_run": int(time.time()),
+        },
+    )
+    await stats_data.execute()
+    return evicted, reclaimed
+
+
+async def report() -> dict[str, int]:
+    stats = await cache.redis.hgetall(EVICT_STATS)
+    return {
+        key: int(stats.get(key) or 0)
+        for key in ("threads", "bytes", "last_threads", "last_bytes", "last_run")
+    }
+
+
+def _keys(id: str) -> tuple[str, str, str, str]:
+    return (
+        cache.NAME_FORMAT.format(id=id),
+        cache.BODY_FORMAT.format(id=id),
+        reviews.REVIEWS_FORMAT.format(id=id),
+        reviews.REVIEWS_ORDER_FORMAT.format(id=id),
+    )
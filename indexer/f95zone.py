@@ -5,13 +5,19 @@ import datetime as dt
 import logging
 import os
 import sys
+import time
 
 import aiohttp
-import aiolimiter
 
 from common import meta
+from indexer import distributed
 
-RATELIMIT = aiolimiter.AsyncLimiter(max_rate=1, time_period=0.5)
+# Shared by all workers and hosts through Redis, adapts to how F95zone responds
+RATELIMIT = distributed.AdaptiveLimiter(
+    "f95zone", max_rate=1, time_period=0.5, floor_rate=0.1, ceiling_rate=2
+)
+RATELIMIT_BACKOFF = dt.timedelta(seconds=5).total_seconds()
+RATELIMIT_SLOW_RESPONSE = dt.timedelta(seconds=5).total_seconds()
 TIMEOUT = aiohttp.ClientTimeout(total=30, connect=30, sock_read=30, sock_connect=30)
 LOGIN_ERROR_MESSAGES = (
     b'<a href="/login/" data-xf-click="overlay">Log in or register now.</a>',
@@ -44,11 +50,11 @@ TEMP_ERROR_MESSAGES = (
 logger = logging.getLogger(__name__)
 session: aiohttp.ClientSession = None
 cookies: dict = None
+backoff_tasks: set[asyncio.Task] = set()
 
 HOST = "https://f95zone.to"
 THREAD_URL = f"{HOST}/threads/{{thread}}"
 VERCHK_URL = f"{HOST}/sam/checker.php?threads={{threads}}"
-SEARCH_URL = f"{HOST}/sam/latest_alpha/latest_data.php?cmd={{cmd}}&cat={{cat}}&page={{page}}&{{search}}={{query}}&sort={{sort}}&rows={{rows}}&_={{ts}}"
 LATEST_URL = f"{HOST}/sam/latest_alpha/latest_data.php?cmd={{cmd}}&cat={{cat}}&page={{page}}&sort={{sort}}&rows={{rows}}&_={{ts}}"
 LATEST_CATEGORIES = (
     "games",
@@ -92,9 +98,14 @@ ERROR_INTERNAL_ERROR = IndexerError(
 @contextlib.asynccontextmanager
 async def lifespan():
     global session, cookies
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_request_end.append(_on_request_end)
+    trace_config.on_request_exception.append(_on_request_exception)
     session = aiohttp.ClientSession(
         cookie_jar=aiohttp.DummyCookieJar(),
         timeout=TIMEOUT,
+        trace_configs=[trace_config],
         headers={
             "User-Agent": (
                 f"F95Indexer/{meta.version} "
@@ -126,6 +137,7 @@ def check_error(
 
         if any((msg in res) for msg in RATELIMIT_FORUM_ERRORS):
             logger.error("Hit F95zone Forum ratelimit")
+            _backoff()
             return ERROR_F95ZONE_RATELIMIT
 
         if any((msg in res) for msg in TEMP_ERROR_MESSAGES):
@@ -137,6 +149,7 @@ def check_error(
 
             if any((msg == res.get("msg")) for msg in RATELIMIT_API_ERRORS):
                 logger.error("Hit F95zone API ratelimit")
+                _backoff()
                 return ERROR_F95ZONE_RATELIMIT
 
             logger.error(f"F95zone API returned an error: {res}")
@@ -146,3 +159,39 @@ def check_error(
         if isinstance(res, (asyncio.TimeoutError, aiohttp.ClientConnectionError)):
             logger.warning("F95zone temporarily unreachable")
             return ERROR_F95ZONE_UNAVAILABLE
+
+
+def _backoff() -> None:
+    # Ratelimit pages can come with any status, so also check content
+    task = asyncio.create_task(RATELIMIT.decrease(RATELIMIT_BACKOFF))
+    backoff_tasks.add(task)
+    task.add_done_callback(backoff_tasks.discard)
+
+
+async def _on_request_start(session, context, params) -> None:
+    context.start = time.monotonic()
+
+
+async def _on_request_end(session, context, params) -> None:
+    # Speed up while F95zone is healthy, slow down at the first signs of struggle
+    latency = time.monotonic() - context.start
+    if params.response.status == 429:
+        rate = await RATELIMIT.decrease(RATELIMIT_BACKOFF)
+        logger.warning(
+            f"Hit a ratelimit, backing off to {rate / RATELIMIT.time_period:.2f}/s"
+        )
+    elif latency > RATELIMIT_SLOW_RESPONSE:
+        rate = await RATELIMIT.decrease()
+        logger.warning(
+            f"Slow response ({latency:.1f}s), slowing to {rate / RATELIMIT.time_period:.2f}/s"
+        )
+    else:
+        await RATELIMIT.increase()
+
+
+async def _on_request_exception(session, context, params) -> None:
+    if isinstance(params.exception, asyncio.TimeoutError):
+        rate = await RATELIMIT.decrease()
+        logger.warning(
+            f"Request timed out, slowing to {rate / RATELIMIT.time_period:.2f}/s"
+        )
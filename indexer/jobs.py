@@ -0,0 +1,167 @@
+import asyncio
+import contextlib
+import datetime as dt
+import logging
+import os
+import socket
+import typing
+
+import redis.exceptions
+
+from external import error
+from indexer import distributed
+
+JOBS_STREAM = "jobs:scrape"
+JOBS_GROUP = "scrapers"
+JOBS_DONE_CHANNEL = "jobs:done"
+JOBS_PENDING_FORMAT = "jobs:pending:{id}"
+JOB_DONE_FORMAT = "{id}:{outcome}"
+JOB_OK = "ok"
+JOB_ERROR = "error"
+JOB_TIMEOUT = dt.timedelta(minutes=5).total_seconds()
+JOB_WAIT_TIMEOUT = dt.timedelta(minutes=2).total_seconds()
+JOBS_BLOCK_TIME = dt.timedelta(seconds=5).total_seconds()
+JOBS_RECLAIM_INTERVAL = dt.timedelta(minutes=1).total_seconds()
+JOBS_DEFAULT_WORKERS = 1
+
+logger = logging.getLogger(__name__)
+enabled = False
+waiters: dict[int, set[asyncio.Future]] = {}
+
+
+@contextlib.asynccontextmanager
+async def lifespan():
+    global enabled
+    enabled = os.environ.get("SCRAPE_QUEUE", "").lower() in ("1", "true", "yes")
+    if not enabled:
+        yield
+        return
+
+    with contextlib.suppress(redis.exceptions.ResponseError):  # BUSYGROUP
+        await distributed.redis.xgroup_create(
+            JOBS_STREAM, JOBS_GROUP, id="$", mkstream=True
+        )
+    done_task = asyncio.create_task(watch_done())
+
+    try:
+        yield
+    finally:
+
+        done_task.cancel()
+        enabled = False
+
+
+@contextlib.asynccontextmanager
+async def workers(handler: typing.Callable[[int], typing.Awaitable]):
+    # Scrape jobs from the queue, API-only processes can set this to 0
+    consume_tasks = []
+    if enabled:
+        count = int(os.environ.get("SCRAPE_WORKERS") or JOBS_DEFAULT_WORKERS)
+        consume_tasks = [
+            asyncio.create_task(consume(handler, number)) for number in range(count)
+        ]
+
+    try:
+        yield
+    finally:
+
+        for task in consume_tasks:
+            task.cancel()
+
+
+async def enqueue(id: int) -> None:
+    # Thread might already be queued by another request or worker
+    pending = JOBS_PENDING_FORMAT.format(id=id)
+    if await distributed.redis.set(pending, 1, nx=True, px=int(JOB_TIMEOUT * 1000)):
+        await distributed.redis.xadd(JOBS_STREAM, {"id": id})
+
+
+async def run(id: int) -> bool:
+    # Returns False if the job failed or no worker finished it in time
+    future = asyncio.get_event_loop().create_future()
+    waiters.setdefault(id, set()).add(future)
+    try:
+        await enqueue(id)
+        return await asyncio.wait_for(future, JOB_WAIT_TIMEOUT)
+    except TimeoutError:
+        return False
+    finally:
+        waiters[id].discard(future)
+        if not waiters[id]:
+            del waiters[id]
+
+
+async def watch_done():
+    while True:
+        try:
+            async with distributed.redis.pubsub() as pubsub:
+                await pubsub.subscribe(JOBS_DONE_CHANNEL)
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    id, outcome = message["data"].split(":")
+                    for future in waiters.get(int(id), ()):
+                        if not future.done():
+                            future.set_result(outcome == JOB_OK)
+        except Exception:
+            logger.error(f"Error watching jobs: {error.text()}\n{error.traceback()}")
+            await asyncio.sleep(JOBS_BLOCK_TIME)
+
+
+async def consume(handler: typing.Callable[[int], typing.Awaitable], number: int):
+    consumer = f"{socket.gethostname()}-{os.getpid()}-{number}"
+    logger.info(f"Scrape worker {consumer} running")
+    next_reclaim = 0
+
+    async def handle(message_id: str, fields: dict[str, str]):
+        id = int(fields["id"])
+        outcome = JOB_ERROR
+        try:
+            await handler(id)
+        except Exception:
+            # Left unacked, will be reclaimed and retried
+            logger.error(f"Error scraping {id}: {error.text()}\n{error.traceback()}")
+        else:
+            ack = distributed.redis.pipeline()
+            ack.xack(JOBS_STREAM, JOBS_GROUP, message_id)
+            ack.xdel(JOBS_STREAM, message_id)
+            ack.delete(JOBS_PENDING_FORMAT.format(id=id))
+            await ack.execute()
+            outcome = JOB_OK
+        finally:
+            # Waiters serve what is cached either way, but only ok means it's fresh
+            await distributed.redis.publish(
+                JOBS_DONE_CHANNEL, JOB_DONE_FORMAT.format(id=id, outcome=outcome)
+            )
+
+    while True:
+        try:
+            # Take over jobs from crashed workers
+            loop_time = asyncio.get_event_loop().time()
+            if loop_time >= next_reclaim:
+                next_reclaim = loop_time + JOBS_RECLAIM_INTERVAL
+                _, reclaimed, _ = await distributed.redis.xautoclaim(
+                    JOBS_STREAM,
+                    JOBS_GROUP,
+                    consumer,
+                    min_idle_time=int(JOB_TIMEOUT * 1000),
+                    count=1,
+                )
+                for message_id, fields in reclaimed:
+                    logger.warning(f"Reclaimed job {message_id} {fields}")
+                    await handle(message_id, fields)
+
+            streams = await distributed.redis.xreadgroup(
+                JOBS_GROUP,
+                consumer,
+                {JOBS_STREAM: ">"},
+                count=1,
+                block=int(JOBS_BLOCK_TIME * 1000),
+            )
+            for _, messages in streams:
+                for message_id, fields in messages:
+                    await handle(message_id, fields)
+
+        except Exception:
+            logger.error(f"Error consuming jobs: {error.text()}\n{error.traceback()}")
+            await asyncio.sleep(JOBS_BLOCK_TIME)
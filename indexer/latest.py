@@ -0,0 +1,45 @@
+import json
+import logging
+
+from indexer import distributed
+
+LATEST_INDEX = "index:latest"
+LATEST_BUILT = "index:latest:built"
+LATEST_FIELDS = (
+    "title",
+    "creator",
+    "rating",
+    "cover",
+    "screens",
+    "ts",
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Latest updates rows by thread id, kept up to date by watcher
+async def store(updates: list[dict]) -> None:
+    if not updates:
+        return
+    await distributed.redis.hset(
+        LATEST_INDEX,
+        mapping={
+            update["thread_id"]: json.dumps(
+                {field: update[field] for field in LATEST_FIELDS}
+            )
+            for update in updates
+        },
+    )
+
+
+async def get(id: int) -> dict | None:
+    update = await distributed.redis.hget(LATEST_INDEX, id)
+    return json.loads(update) if update else None
+
+
+async def is_built() -> bool:
+    return bool(await distributed.redis.exists(LATEST_BUILT))
+
+
+async def mark_built() -> None:
+    await distributed.redis.set(LATEST_BUILT, 1)
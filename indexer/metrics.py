@@ -0,0 +1,258 @@
+import asyncio
+import bisect
+import contextlib
+import datetime as dt
+import json
+import logging
+import os
+import socket
+import time
+
+import redis.asyncio as aredis
+
+from external import error
+
+# Each process keeps its own numbers and publishes them, any worker can then
+# serve the sum of all of them
+METRICS_FORMAT = "metrics:{worker}"
+METRICS_FLUSH_INTERVAL = dt.timedelta(seconds=15).total_seconds()
+METRICS_TTL = dt.timedelta(minutes=1).total_seconds()
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SWEEP_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 900, 1800, 3600, 21600, 43200)
+
+logger = logging.getLogger(__name__)
+redis: aredis.Redis = None
+worker = f"{socket.gethostname()}:{os.getpid()}"
+registry: list["Counter | Histogram"] = []
+
+
+class Counter:
+    __slots__ = (
+        "name",
+        "help",
+        "labels",
+        "values",
+    )
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple[str, ...], float] = {}
+        registry.append(self)
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def merge(self, merged: dict, snapshot: dict) -> None:
+        for labels, value in snapshot.items():
+            merged[labels] = merged.get(labels, 0) + value
+
+    def render(self, merged: dict) -> list[str]:
+        return [
+            f"{self.name}{_labels(self.labels, json.loads(labels))} {value}"
+            for labels, value in sorted(merged.items())
+        ]
+
+
+class Gauge(Counter):
+    __slots__ = ()
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels: str, value: float) -> None:
+        self.values[labels] = value
+
+
+class Histogram(Counter):
+    # Values are counts per bucket, then one for above all buckets, then the sum
+    __slots__ = ("buckets",)
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels: str) -> None:
+        if not (counts := self.values.get(labels)):
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, *labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def merge(self, merged: dict, snapshot: dict) -> None:
+        for labels, counts in snapshot.items():
+            if labels not in merged:
+                merged[labels] = [0] * len(counts)
+            merged[labels] = [x + y for x, y in zip(merged[labels], counts)]
+
+    def render(self, merged: dict) -> list[str]:
+        lines = []
+        for labels, counts in sorted(merged.items()):
+            labels = json.loads(labels)
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = _labels((*self.labels, "le"), (*labels, str(bound)))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {counts[-1]}")
+            lines.append(
+                f"{self.name}_count{_labels(self.labels, labels)} {cumulative}"
+            )
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    "indexer_request_seconds", "API request latency", ("route", "status")
+)
+CACHE_LOOKUPS = Counter(
+    "indexer_cache_lookups_total", "Thread lookups by cache status", ("status",)
+)
+HOT_CACHE_LOOKUPS = Counter(
+    "indexer_hot_cache_lookups_total", "In-process cache lookups", ("result",)
+)
+HOT_CACHE_BYTES = Gauge("indexer_hot_cache_bytes", "In-process cache size")
+SCRAPE_SECONDS = Histogram(
+    "indexer_scrape_seconds", "Thread scrape duration by outcome", ("result",)
+)
+SCRAPE_STEP_SECONDS = Histogram(
+    "indexer_scrape_step_seconds", "Thread scrape duration by step", ("step",)
+)
+PARSER_SECONDS = Histogram(
+    "indexer_parser_seconds", "Parser pool queue wait and parse time", ("stage",)
+)
+LOCK_WAIT_SECONDS = Histogram(
+    "indexer_lock_wait_seconds", "Time waiting for thread locks"
+)
+LIMITER_WAITING = Gauge(
+    "indexer_limiter_waiting", "Requests waiting for a ratelimit", ("limiter",)
+)
+LIMITER_WAIT_SECONDS = Histogram(
+    "indexer_limiter_wait_seconds", "Time waiting for a ratelimit", ("limiter",)
+)
+WATCHER_SECONDS = Histogram(
+    "indexer_watcher_seconds",
+    "Watcher poll and sweep duration",
+    ("watcher",),
+    SWEEP_BUCKETS,
+)
+WATCHER_INVALIDATIONS = Counter(
+    "indexer_watcher_invalidations_total",
+    "Threads invalidated by watchers",
+    ("watcher",),
+)
+REDIS_ROUND_TRIPS = Counter(
+    "indexer_redis_round_trips_total", "Commands and pipelines sent to Redis"
+)
+
+
+class RedisConnection(aredis.Connection):
+    # Pipelines are sent at once, so this counts round trips and not commands
+    async def send_packed_command(self, command, check_health: bool = True) -> None:
+        REDIS_ROUND_TRIPS.inc()
+        await super().send_packed_command(command, check_health)
+
+
+def redis_client(decode_responses: bool) -> aredis.Redis:
+    # From pool so closing the client also closes its connections
+    return aredis.Redis.from_pool(
+        aredis.ConnectionPool(
+            connection_class=RedisConnection, decode_responses=decode_responses
+        )
+    )
+
+
+@contextlib.asynccontextmanager
+async def lifespan():
+    global redis
+    redis = redis_client(decode_responses=True)
+    await redis.ping()
+    flush_task = asyncio.create_task(flush_loop())
+
+    try:
+        yield
+    finally:
+
+        flush_task.cancel()
+        await redis.aclose()
+        redis = None
+
+
+async def middleware(request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    REQUEST_SECONDS.observe(
+        time.perf_counter() - start,
+        route.path if route else "unmatched",
+        str(response.status_code),
+    )
+    return response
+
+
+async def flush_loop() -> None:
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            await flush()
+        except Exception:
+            logger.error(f"Error saving metrics: {error.text()}\n{error.traceback()}")
+
+
+async def flush() -> None:
+    snapshot = {
+        metric.name: {
+            json.dumps(labels): value for labels, value in metric.values.items()
+        }
+        for metric in registry
+    }
+    await redis.set(
+        METRICS_FORMAT.format(worker=worker),
+        json.dumps(snapshot),
+        ex=int(METRICS_TTL),
+    )
+
+
+async def render() -> str:
+    # Include what happened since the last flush in this worker
+    await flush()
+    names = [name async for name in redis.scan_iter(METRICS_FORMAT.format(worker="*"))]
+    snapshots = [json.loads(data) for data in await redis.mget(names) if data]
+
+    lines = []
+    for metric in registry:
+        merged = {}
+        for snapshot in snapshots:
+            metric.merge(merged, snapshot.get(metric.name, {}))
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines += metric.render(merged)
+    return "\n".join(lines) + "\n"
+
+
+def _labels(names: tuple[str, ...], values: list[str]) -> str:
+    if not names:
+        return ""
+    escaped = (
+        value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in values
+    )
+    return (
+        "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+    )
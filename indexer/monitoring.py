@@ -0,0 +1,122 @@
+import contextlib
+import logging
+import os
+import secrets
+
+import fastapi
+import zstandard
+
+from indexer import (
+    cache,
+    eviction,
+    f95zone,
+    metrics,
+    tracing,
+)
+
+logger = logging.getLogger(__name__)
+token = ""
+
+
+@contextlib.asynccontextmanager
+async def lifespan():
+    global token
+    token = os.environ.get("MONITORING_TOKEN") or ""
+
+    try:
+        yield
+    finally:
+
+        token = ""
+
+
+async def authorize(request: fastapi.Request):
+    # Traces hold pages scraped with the indexer's session, so none of this is
+    # public, and without a token it's not served at all
+    if not token:
+        raise fastapi.HTTPException(status_code=404)
+    authorization = request.headers.get("Authorization", "")
+    if not secrets.compare_digest(authorization.encode(), f"Bearer {token}".encode()):
+        raise fastapi.HTTPException(status_code=401)
+
+
+router = fastapi.APIRouter(dependencies=[fastapi.Depends(authorize)])
+
+
+@router.get("/ratelimit")
+async def ratelimit_request():
+    return fastapi.responses.JSONResponse(
+        await f95zone.RATELIMIT.state(),
+        headers={"Cache-Control": "no-store"},
+    )
+
+
+@router.get("/expire")
+async def expire_request():
+    # Scrapes per day with learned TTLs against the fixed ones
+    return fastapi.responses.JSONResponse(
+        await cache.expire_report(),
+        headers={"Cache-Control": "no-store"},
+    )
+
+
+@router.get("/evict")
+async def evict_request():
+    # Threads and bytes reclaimed from Redis by dropping unused threads
+    return fastapi.responses.JSONResponse(
+        await eviction.report(),
+        headers={"Cache-Control": "no-store"},
+    )
+
+
+@router.get("/hotcache")
+async def hotcache_request():
+    # Hits and misses of this worker's in-process cache
+    return fastapi.responses.JSONResponse(
+        cache.hot_cache.stats(),
+        headers={"Cache-Control": "no-store"},
+    )
+
+
+@router.get("/metrics")
+async def metrics_request():
+    # Prometheus text format, summed over all workers
+    return fastapi.responses.PlainTextResponse(
+        await metrics.render(),
+        headers={"Cache-Control": "no-store"},
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+@router.get("/traces")
+async def traces_request(format: str = "json"):
+    # Sampled, slowest and failed scrapes of this worker
+    if format == "otlp":
+        content = tracing.to_otlp(tracing.retained())
+    else:
+        content = {
+            "recent": [tracing.to_json(trace) for trace in tracing.recent],
+            "slowest": [
+                tracing.to_json(trace)
+                for _, _, trace in sorted(tracing.slowest, reverse=True)
+            ],
+            "failures": [tracing.to_json(trace) for trace in tracing.failures],
+        }
+    return fastapi.responses.JSONResponse(
+        content,
+        headers={"Cache-Control": "no-store"},
+    )
+
+
+@router.get("/traces/{trace_id}/dumps/{name}")
+async def trace_dump_request(trace_id: str, name: str):
+    # Page or traceback kept when parsing failed
+    if not (trace := tracing.find(trace_id)) or name not in trace.dumps:
+        return fastapi.responses.JSONResponse(
+            "Trace dump not found",
+            status_code=404,
+        )
+    return fastapi.responses.PlainTextResponse(
+        zstandard.decompress(trace.dumps[name]).decode(errors="replace"),
+        headers={"Cache-Control": "no-store"},
+    )
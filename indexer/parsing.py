@@ -0,0 +1,87 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import logging
+import multiprocessing
+import os
+import time
+import typing
+
+from common import parser
+from indexer import (
+    metrics,
+    tracing,
+)
+
+# Spare CPUs are split between API worker processes, each has its own pool
+PARSER_SPARE_CPUS = max(1, (os.cpu_count() or 1) - 1)
+PARSER_QUEUE_PER_WORKER = 4
+PARSER_SLOW_LOG_TIME = 5.0
+
+logger = logging.getLogger(__name__)
+pool: concurrent.futures.ProcessPoolExecutor = None
+queue: asyncio.Semaphore = None
+
+
+@contextlib.asynccontextmanager
+async def lifespan():
+    global pool, queue
+    workers = int(
+        os.environ.get("PARSER_WORKERS")
+        or max(1, PARSER_SPARE_CPUS // int(os.environ.get("WORKERS") or 1))
+    )
+    # Spawn instead of fork, the event loop and its threads don't survive forking
+    pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+    queue = asyncio.Semaphore(workers * PARSER_QUEUE_PER_WORKER)
+
+    # Start all workers now, so first scrapes don't wait on imports
+    loop = asyncio.get_event_loop()
+    await asyncio.gather(
+        *(loop.run_in_executor(pool, time.sleep, 0.1) for _ in range(workers))
+    )
+    logger.info(f"Parser pool running with {workers} workers")
+
+    try:
+        yield
+    finally:
+
+        pool.shutdown(wait=False, cancel_futures=True)
+        pool = None
+        queue = None
+
+
+async def thread(res: bytes) -> parser.ParsedThread | parser.ParserError:
+    return await _run(parser.thread, res)
+
+
+async def reviews(res: bytes) -> parser.ParsedReviews | parser.ParserError:
+    return await _run(parser.reviews, res)
+
+
+def _timed(func: typing.Callable, res: bytes) -> tuple[typing.Any, float, float]:
+    started = time.time()
+    ret = func(res)
+    return ret, started, time.time()
+
+
+async def _run(func: typing.Callable, res: bytes):
+    submitted = time.time()
+    loop = asyncio.get_event_loop()
+    async with queue:
+        ret, started, finished = await loop.run_in_executor(pool, _timed, func, res)
+
+    queue_wait = started - submitted
+    parse_time = finished - started
+    metrics.PARSER_SECONDS.observe(queue_wait, "queue")
+    metrics.PARSER_SECONDS.observe(parse_time, "parse")
+    tracing.record(func.__name__, started, finished, queue_wait=queue_wait)
+    if queue_wait + parse_time > PARSER_SLOW_LOG_TIME:
+        logger.warning(
+            f"Slow {func.__name__} parse: "
+            f"waited {queue_wait:.2f}s, parsed in {parse_time:.2f}s"
+        )
+
+    return ret
@@ -0,0 +1,62 @@
+import json
+import logging
+
+import redis.asyncio as aredis
+
+from indexer import distributed
+
+REVIEWS_FORMAT = "reviews:{id}"
+REVIEWS_ORDER_FORMAT = "reviews:{id}:order"
+
+logger = logging.getLogger(__name__)
+
+
+# Each user has one review per thread, ordered by when it was posted
+def store(pipeline: aredis.client.Pipeline, id: int, items: list[dict]) -> None:
+    if not items:
+        return
+    pipeline.hset(
+        REVIEWS_FORMAT.format(id=id),
+        mapping={item["user"]: json.dumps(item) for item in items},
+    )
+    pipeline.zadd(
+        REVIEWS_ORDER_FORMAT.format(id=id),
+        {item["user"]: item["timestamp"] for item in items},
+    )
+
+
+async def get(id: int, before: int | None, limit: int) -> tuple[list[dict], int | None]:
+    # Newest first, next page starts before the last timestamp returned
+    users = await distributed.redis.zrevrangebyscore(
+        REVIEWS_ORDER_FORMAT.format(id=id),
+        f"({before}" if before is not None else "+inf",
+        "-inf",
+        start=0,
+        num=limit + 1,
+        withscores=True,
+    )
+    next_before = None
+    if len(users) > limit:
+        # More pages, but don't split a single second across them
+        last_second = users[limit - 1][1]
+        split = users[limit][1] == last_second
+        users = users[:limit]
+        if split and users[0][1] != last_second:
+            while users[-1][1] == last_second:
+                users.pop()
+        elif split:
+            # Whole page is one second, send all of it
+            users = await distributed.redis.zrevrangebyscore(
+                REVIEWS_ORDER_FORMAT.format(id=id),
+                last_second,
+                last_second,
+                withscores=True,
+            )
+        next_before = int(users[-1][1])
+    if not users:
+        return [], None
+
+    items = await distributed.redis.hmget(
+        REVIEWS_FORMAT.format(id=id), [user for user, _ in users]
+    )
+    return [json.loads(item) for item in items if item], next_before
@@ -0,0 +1,78 @@
+import asyncio
+import contextlib
+import datetime as dt
+import logging
+import os
+import time
+
+from external import error
+from indexer import (
+    cache,
+    distributed,
+    f95zone,
+)
+
+REFRESH_DEFAULT_SHARE = 0.25
+REFRESH_REQUESTS_PER_SCRAPE = 2  # Thread and reviews, versions are batched
+REFRESH_IDLE_INTERVAL = dt.timedelta(seconds=30).total_seconds()
+REFRESH_BATCH_SIZE = 100
+
+logger = logging.getLogger(__name__)
+
+
+@contextlib.asynccontextmanager
+async def lifespan():
+    share = float(os.environ.get("REFRESH_SCHEDULER_SHARE", REFRESH_DEFAULT_SHARE))
+    refresh_task = None
+    if share > 0:
+        refresh_task = asyncio.create_task(refresh_expired(share))
+
+    try:
+        yield
+    finally:
+
+        if refresh_task:
+            refresh_task.cancel()
+
+
+async def refresh_expired(share: float):
+    await asyncio.sleep(30)
+
+    # Only one worker schedules refreshes, the others wait to take over
+    async with distributed.lock("refresh_expired"):
+        logger.info(f"Refresh scheduler running, using {share:.0%} of the ratelimit")
+        await _refresh_expired_loop(share)
+
+
+async def _refresh_expired_loop(share: float):
+    while True:
+        try:
+            due = await cache.redis.zrangebyscore(
+                cache.EXPIRE_INDEX,
+                "-inf",
+                time.time(),
+                start=0,
+                num=REFRESH_BATCH_SIZE,
+            )
+            if not due:
+                await asyncio.sleep(REFRESH_IDLE_INTERVAL)
+                continue
+
+            logger.info(f"Refresh: {len(due)} threads due")
+            for id in due:
+                start = time.monotonic()
+                await cache.refresh_thread(int(id))
+
+                # Only spend a share of the F95zone ratelimit on proactive refreshes,
+                # following it as it adapts
+                state = await f95zone.RATELIMIT.state()
+                scrape_period = REFRESH_REQUESTS_PER_SCRAPE / (
+                    state["requests_per_second"] * share
+                )
+                await asyncio.sleep(max(0, scrape_period - (time.monotonic() - start)))
+
+        except Exception:
+            logger.error(
+                f"Error refreshing threads: {error.text()}\n{error.traceback()}"
+            )
+            await asyncio.sleep(REFRESH_IDLE_INTERVAL)
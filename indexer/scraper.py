@@ -1,188 +1,178 @@
-import asyncio
 import dataclasses
+import hashlib
 import json
 import logging
 import re
 import time
 
-from common import parser
-from indexer import f95zone
+import aiohttp
+
+from common import meta, parser
+from indexer import (
+    f95zone,
+    latest,
+    parsing,
+    tracing,
+    versions,
+)
+
+# Returned when pages are the same as last scrape, so there is nothing to parse
+UNCHANGED = "UNCHANGED"
+# Reviews to store one by one, popped by cache before saving the rest
+NEW_REVIEWS = "NEW_REVIEWS"
+REVIEWS_MAX_PAGES = 5
+# Kept in state across errors, unlike validators and digests
+REVIEWS_PROGRESS = ("reviews_total", "reviews_newest")
+# Only hash the parts of pages that are parsed, minus what changes on every load
+THREAD_DIGEST_START = b'<div class="p-body-header'
+THREAD_DIGEST_AFTER = b"message-threadStarterPost"
+THREAD_DIGEST_ENDS = (
+    b'<article class="message ',
+    b'<div class="block-outer block-outer--after',
+)
+REVIEWS_DIGEST_START = b'<div class="p-body-pageContent'
+REVIEWS_DIGEST_ENDS = (b"<footer",)
+REVIEWS_DISABLED = "disabled"
+DIGEST_VOLATILE = (
+    (re.compile(rb"(<time[^>]*>)[^<]*(</time>)"), rb"\1\2"),
+    (re.compile(rb'(name="_xfToken" value=")[^"]*'), rb"\1"),
+    (re.compile(rb'(data-csrf=")[^"]*'), rb"\1"),
+)
 
 logger = logging.getLogger(__name__)
 
 
-async def thread(id: int) -> dict[str, str] | f95zone.IndexerError | None:
-    thread_url = f95zone.THREAD_URL.format(thread=id)
-    retries = 10
-    while retries:
-        async with f95zone.RATELIMIT:
-            try:
-                async with f95zone.session.get(
-                    thread_url,
-                    cookies=f95zone.cookies,
-                ) as req:
-                    if req.status == 429 and retries > 1:
-                        logger.warning("Hit a ratelimit, sleeping 2 seconds")
-                        await asyncio.sleep(2)
-                        retries -= 1
-                        continue
-                    res = await req.read()
-                    break
-            except Exception as exc:
-                if index_error := f95zone.check_error(exc, logger):
-                    return index_error
-                raise
+async def thread(
+    id: int, state: dict[str, str | bool]
+) -> dict[str, str] | f95zone.IndexerError | str:
+    with tracing.trace(id) as trace:
+        ret = await _thread(id, state)
+        if isinstance(ret, f95zone.IndexerError):
+            trace.result = ret.error_flag
+        else:
+            trace.result = UNCHANGED if ret == UNCHANGED else "parsed"
+        return ret
 
-    if index_error := f95zone.check_error(res, logger):
-        return index_error
 
-    loop = asyncio.get_event_loop()
-    ret = await loop.run_in_executor(None, parser.thread, res)
-    if isinstance(ret, parser.ParserError):
+async def _thread(
+    id: int, state: dict[str, str | bool]
+) -> dict[str, str] | f95zone.IndexerError | str:
+    # State has validators and digests of the last scrape, updated in place
+    thread_url = f95zone.THREAD_URL.format(thread=id)
+    reviews_url = thread_url + "/br-reviews/"
 
-        if ret.message == "Thread structure missing" and req.status in (403, 404):
-            return f95zone.ERROR_THREAD_MISSING
+    with tracing.step("thread"):
+        fetched = await _fetch(thread_url, state, "thread")
+    if isinstance(fetched, f95zone.IndexerError):
+        return fetched
+    thread_req, thread_res = fetched
 
-        logger.error(f"Thread {id} parsing failed: {ret.message}\n{ret.dump}")
-        return f95zone.ERROR_PARSING_FAILED
+    # Missing threads need no version lookup or reviews, find out before those
+    if thread_req.status in (403, 404):
+        with tracing.step("parse"):
+            ret = await parsing.thread(thread_res)
+        if (
+            isinstance(ret, parser.ParserError)
+            and ret.message == "Thread structure missing"
+        ):
+            return f95zone.ERROR_THREAD_MISSING
 
     # TODO: maybe add an error flag for threads outside of
     # games/media/mods forums so it wont get cached for no reason
 
     # Check if thread is tracked by latest updates using version API, then keep this version value
-    version = ""
-    try:
-        async with f95zone.session.get(
-            f95zone.VERCHK_URL.format(threads=id),
-        ) as req:
-            res = await req.read()
-    except Exception as exc:
-        if index_error := f95zone.check_error(exc, logger):
-            return index_error
-        raise
-    if index_error := f95zone.check_error(res, logger):
-        return index_error
-    try:
-        versions = json.loads(res)
-    except Exception:
-        logger.error(f"Thread {id} version returned invalid JSON: {res}")
-        return f95zone.ERROR_UNKNOWN_RESPONSE
-    if versions.get("msg") in ("Missing threads data", "Thread not found"):
-        versions["status"] = "ok"
-        versions["msg"] = {}
-    if index_error := f95zone.check_error(versions, logger):
-        return index_error
-    if str(id) in versions["msg"]:
-        version = versions["msg"][str(id)]
-        if version == "Unknown":
-            version = ""
+    with tracing.step("version"):
+        version = await versions.lookup(id)
+    if isinstance(version, f95zone.IndexerError):
+        return version
+    with tracing.step("latest"):
+        update = await latest.get(id) if version else None
 
-    # If tracked by latest updates, try to search the thread there to get more precise details
-    if version:
-        query = ret.name.encode("ascii", errors="replace").decode()
-        query = re.sub(r"\.+ | \.+", " ", query)
-        for char in "?&/':;-":
-            query = query.replace(char, " ")
-        query = re.sub(r"\s+", " ", query).strip()[:28]
-        if len(words := query.split(" ")) > 2 and len(words[-1]) < 3:
-            query = " ".join(words[:-1])
-        for category in f95zone.LATEST_CATEGORIES:
-
-            try:
-                async with f95zone.session.get(
-                    f95zone.SEARCH_URL.format(
-                        cmd="list",
-                        cat=category,
-                        page=1,
-                        search="search",
-                        query=query,
-                        sort="likes",
-                        rows=90,
-                        ts=int(time.time()),
-                    ),
-                    cookies=f95zone.cookies,
-                ) as req:
-                    res = await req.read()
-            except Exception as exc:
-                if index_error := f95zone.check_error(exc, logger):
-                    return index_error
-                raise
-            if index_error := f95zone.check_error(res, logger):
-                return index_error
-            try:
-                updates = json.loads(res)
-            except Exception:
-                logger.error(f"Thread {id} search returned invalid JSON: {res}")
-                return f95zone.ERROR_UNKNOWN_RESPONSE
-            if index_error := f95zone.check_error(updates, logger):
-                return index_error
-
-            for update in updates["msg"]["data"]:
-                if update["thread_id"] == id:
-                    ret.name = update["title"] or ret.name
-                    ret.developer = update["creator"] or ret.developer
-                    ret.score = round(update["rating"], 1)
-                    ret.image_url = parser.attachment(update["cover"]) or ret.image_url
-                    ret.previews_urls = [
-                        parser.attachment(preview_url)
-                        for preview_url in update["screens"]
-                    ] or ret.previews_urls
-                    last_promoted = parser.datestamp(update["ts"])
-                    if (
-                        ret.last_updated > time.time()  # Only if thread has a typo
-                        or last_promoted > ret.last_updated  # Or it's outdated
-                    ):
-                        ret.last_updated = last_promoted
-                    break
-            else:  # Didn't break
-                continue
-            break
+    with tracing.step("reviews"):
+        fetched = await _fetch(reviews_url, state, "reviews")
+    if isinstance(fetched, f95zone.IndexerError):
+        return fetched
+    reviews_req, reviews_res = fetched
 
-        else:  # Didn't break
-            logger.warning(f"Thread {id} not found in latest updates search")
+    # Skip parsing if nothing that would end up in the cache changed
+    digest = _digest(state, version, update)
+    if digest and digest == state.get("digest"):
+        return UNCHANGED
 
-    retries = 10
-    while retries:
-        async with f95zone.RATELIMIT:
-            try:
-                async with f95zone.session.get(
-                    thread_url + "/br-reviews/",
-                    cookies=f95zone.cookies,
-                ) as req:
-                    if req.status == 429 and retries > 1:
-                        logger.warning("Hit a ratelimit, sleeping 2 seconds")
-                        await asyncio.sleep(2)
-                        retries -= 1
-                        continue
-                    res = await req.read()
-                    break
-            except Exception as exc:
-                if index_error := f95zone.check_error(exc, logger):
-                    return index_error
-                raise
+    # Not modified responses have no body to parse, so get it again
+    if thread_req.status == 304:
+        with tracing.step("thread"):
+            fetched = await _fetch(thread_url, state, "thread", conditional=False)
+        if isinstance(fetched, f95zone.IndexerError):
+            return fetched
+        thread_req, thread_res = fetched
+    if reviews_req.status == 304:
+        with tracing.step("reviews"):
+            fetched = await _fetch(reviews_url, state, "reviews", conditional=False)
+        if isinstance(fetched, f95zone.IndexerError):
+            return fetched
+        reviews_req, reviews_res = fetched
 
-    if index_error := f95zone.check_error(res, logger):
-        return index_error
+    with tracing.step("parse"):
+        ret = await parsing.thread(thread_res)
+    if isinstance(ret, parser.ParserError):
+
+        missing = thread_req.status in (403, 404)
+        if ret.message == "Thread structure missing" and missing:
+            return f95zone.ERROR_THREAD_MISSING
 
-    if not str(req.real_url).rstrip("/").endswith("br-reviews"):
+        # Keep the page with the trace instead of logging all of it
+        trace_id = tracing.dump("thread", thread_res)
+        if isinstance(ret.dump, str):
+            tracing.dump("thread_traceback", ret.dump)
+        logger.error(f"Thread {id} parsing failed: {ret.message} (trace {trace_id})")
+        return f95zone.ERROR_PARSING_FAILED
+
+    # If tracked by latest updates, use the details watcher found there
+    if version:
+        if update:
+            ret.name = update["title"] or ret.name
+            ret.developer = update["creator"] or ret.developer
+            ret.score = round(update["rating"], 1)
+            ret.image_url = parser.attachment(update["cover"]) or ret.image_url
+            ret.previews_urls = [
+                parser.attachment(preview_url) for preview_url in update["screens"]
+            ] or ret.previews_urls
+            last_promoted = parser.datestamp(update["ts"])
+            if (
+                ret.last_updated > time.time()  # Only if thread has a typo
+                or last_promoted > ret.last_updated  # Or it's outdated
+            ):
+                ret.last_updated = last_promoted
+        else:
+            logger.warning(f"Thread {id} not found in latest updates index")
+
+    if not _reviews_enabled(reviews_req):
         # Some threads have reviews disabled
         reviews = parser.ParsedReviews(total=0, items=[])
+        new_reviews = []
     else:
-        reviews = await loop.run_in_executor(None, parser.reviews, res)
+        with tracing.step("parse"):
+            reviews = await parsing.reviews(reviews_res)
         if isinstance(reviews, parser.ParserError):
 
-            if reviews.message == "Thread structure missing" and req.status in (
-                403,
-                404,
-            ):
+            missing = reviews_req.status in (403, 404)
+            if reviews.message == "Thread structure missing" and missing:
                 return f95zone.ERROR_THREAD_MISSING
 
+            trace_id = tracing.dump("reviews", reviews_res)
+            if isinstance(reviews.dump, str):
+                tracing.dump("reviews_traceback", reviews.dump)
             logger.error(
-                f"Thread {id} reviews parsing failed: {reviews.message}\n{reviews.dump}"
+                f"Thread {id} reviews parsing failed: {reviews.message} (trace {trace_id})"
             )
             return f95zone.ERROR_PARSING_FAILED
 
         reviews.items = [dataclasses.asdict(review) for review in reviews.items]
+        with tracing.step("older_reviews"):
+            new_reviews = await _older_reviews(id, reviews_url, reviews, state)
+
+    state["digest"] = _digest(state, version, update)
 
     # Prepare for redis, only strings allowed
     parsed = dataclasses.asdict(ret)
@@ -206,4 +196,148 @@ async def thread(id: int) -> dict[str, str] | f95zone.IndexerError | None:
     parsed["downloads"] = json.dumps(parsed["downloads"])
     parsed["reviews_total"] = str(reviews.total)
     parsed["reviews"] = json.dumps(reviews.items)
+    parsed[NEW_REVIEWS] = new_reviews
     return parsed
+
+
+async def _older_reviews(
+    id: int,
+    reviews_url: str,
+    reviews: parser.ParsedReviews,
+    state: dict[str, str | bool],
+) -> list[dict]:
+    # First page is always stored again for its likes, older pages only
+    # when more reviews were added than it shows, until one we already know
+    # Without a previous total, like on first scrape, only the first page is kept
+    known_newest = state.get("reviews_newest", 0)
+    added = reviews.total - state.get("reviews_total", reviews.total)
+    new_reviews = list(reviews.items)
+    page_items = reviews.items
+    page = 1
+    while (
+        page < REVIEWS_MAX_PAGES
+        and page_items
+        and len(new_reviews) < added
+        and page_items[-1]["timestamp"] > known_newest
+    ):
+        page += 1
+        fetched = await _fetch(f"{reviews_url}page-{page}", {}, "reviews")
+        if isinstance(fetched, f95zone.IndexerError):
+            break
+        _, res = fetched
+        older = await parsing.reviews(res)
+        if isinstance(older, parser.ParserError):
+            logger.warning(f"Thread {id} reviews page {page} parsing failed")
+            break
+        page_items = [
+            dataclasses.asdict(review)
+            for review in older.items
+            if review.timestamp > known_newest
+        ]
+        new_reviews += page_items
+        if len(page_items) < len(older.items):
+            break
+
+    if new_reviews:
+        state["reviews_newest"] = max(
+            known_newest, *(review["timestamp"] for review in new_reviews)
+        )
+    state["reviews_total"] = reviews.total
+    return new_reviews
+
+
+async def _fetch(
+    url: str, state: dict[str, str | bool], page: str, conditional: bool = True
+) -> tuple[aiohttp.ClientResponse, bytes] | f95zone.IndexerError:
+    # Send validators from last time, in case F95zone supports them
+    headers = {}
+    if conditional and (etag := state.get(f"{page}_etag")):
+        headers["If-None-Match"] = etag
+    if conditional and (last_modified := state.get(f"{page}_last_modified")):
+        headers["If-Modified-Since"] = last_modified
+
+    retries = 10
+    while retries:
+        # Each attempt is traced, including the wait for the ratelimit
+        with tracing.span("request", url=url, page=page) as attributes:
+            async with f95zone.RATELIMIT:
+                attributes["sent"] = time.time()
+                try:
+                    async with f95zone.session.get(
+                        url,
+                        cookies=f95zone.cookies,
+                        headers=headers,
+                    ) as req:
+                        attributes["status"] = req.status
+                        if req.status == 429 and retries > 1:
+                            # Ratelimit backs off by itself, retry when it allows
+                            retries -= 1
+                            continue
+                        res = await req.read()
+                        attributes["bytes"] = len(res)
+                        break
+                except Exception as exc:
+                    attributes["error"] = type(exc).__name__
+                    if index_error := f95zone.check_error(exc, logger):
+                        return index_error
+                    raise
+
+    if req.status == 304:
+        return req, res
+    if index_error := f95zone.check_error(res, logger):
+        return index_error
+
+    state[f"{page}_etag"] = req.headers.get("ETag", "")
+    state[f"{page}_last_modified"] = req.headers.get("Last-Modified", "")
+    if page == "thread":
+        state["thread_digest"] = _page_digest(
+            res, THREAD_DIGEST_START, THREAD_DIGEST_AFTER, THREAD_DIGEST_ENDS
+        )
+    elif _reviews_enabled(req):
+        state["reviews_digest"] = _page_digest(
+            res, REVIEWS_DIGEST_START, REVIEWS_DIGEST_START, REVIEWS_DIGEST_ENDS
+        )
+    else:
+        state["reviews_digest"] = REVIEWS_DISABLED
+    return req, res
+
+
+def _reviews_enabled(req: aiohttp.ClientResponse) -> bool:
+    # Threads with reviews disabled redirect back to the thread
+    return str(req.real_url).rstrip("/").endswith("br-reviews")
+
+
+def _page_digest(
+    res: bytes, start: bytes, after: bytes, ends: tuple[bytes, ...]
+) -> str:
+    # Empty if the page doesn't look like we expect, so it never matches
+    start = res.find(start)
+    after = res.find(after, start)
+    if start == -1 or after == -1:
+        return ""
+    end = len(res)
+    for marker in ends:
+        if (index := res.find(marker, after + 1)) != -1:
+            end = index
+            break
+    region = res[start:end]
+    for pattern, replacement in DIGEST_VOLATILE:
+        region = pattern.sub(replacement, region)
+    return hashlib.md5(region).hexdigest()
+
+
+def _digest(state: dict[str, str | bool], version: str, update: dict | None) -> str:
+    # Everything a scrape result is made from, including which parser made it
+    if not state.get("thread_digest") or not state.get("reviews_digest"):
+        return ""
+    return hashlib.md5(
+        json.dumps(
+            (
+                meta.version,
+                state["thread_digest"],
+                state["reviews_digest"],
+                version,
+                update,
+            )
+        ).encode()
+    ).hexdigest()
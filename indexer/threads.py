@@ -1,21 +1,32 @@
 import asyncio
+import hashlib
+import json
+import logging
+import math
 import time
 
 import fastapi
 
+from common import meta
+from external import error
 from indexer import (
     cache,
     f95zone,
+    reviews,
 )
 
 FAST_MAX_IDS = 10
+FULL_MAX_IDS = 50
+CHANGES_MAX_IDS = 1000
+REVIEWS_MAX_ITEMS = 100
 VALID_THREAD_IDS = range(1, 1_000_000)  # Top ID was ~232k at time of writing
 
+logger = logging.getLogger(__name__)
 router = fastapi.APIRouter()
 
 
 @router.get("/fast")
-async def fast_request(ids: str):
+async def fast_request(request: fastapi.Request, ids: str):
     ids = ids.split(",")
     if len(ids) > FAST_MAX_IDS:
         return fastapi.responses.JSONResponse(
@@ -37,17 +48,75 @@ async def fast_request(ids: str):
             status_code=400,
         )
 
-    tasks = [cache.last_change(id) for id in ids]
-    last_changes = await asyncio.gather(*tasks)
-    results = dict(zip(ids, last_changes))
+    last_changes, cache_status = await cache.last_changes(
+        list(ids), client_address(request)
+    )
+    if cache_status == cache.STATUS_SHED and not last_changes:
+        return shed_response()
+    last_changes = dict(sorted(last_changes.items()))
+
+    headers = {
+        "ETag": etag(meta.version, list(last_changes.items())),
+        cache.STATUS_HEADER: cache_status,
+    }
+    if cache_status == cache.STATUS_SHED:
+        # Shed threads are left out, clients can ask for them again after this
+        headers["Retry-After"] = retry_after()
+    if not_modified(request, headers["ETag"]):
+        return fastapi.responses.Response(status_code=304, headers=headers)
+
+    return fastapi.responses.JSONResponse(
+        last_changes,
+        status_code=200,
+        headers=headers,
+    )
+
+
+@router.get("/changes")
+async def changes_request(since: int):
+    if since > time.time():
+        return fastapi.responses.JSONResponse(
+            "Invalid timestamp",
+            status_code=406,
+        )
+
+    changes, next_since = await cache.changes_since(since, CHANGES_MAX_IDS)
+    return fastapi.responses.JSONResponse(
+        {
+            "changes": changes,
+            "next": next_since,
+        },
+        status_code=200,
+    )
+
+
+@router.get("/reviews/{id}")
+async def reviews_request(id: int, before: int | None = None):
+    if id not in VALID_THREAD_IDS:
+        return fastapi.responses.JSONResponse(
+            "Invalid thread ID",
+            status_code=400,
+        )
+
+    # Full only has the newest reviews, older ones are paginated here
+    items, next_before = await reviews.get(id, before, REVIEWS_MAX_ITEMS)
     return fastapi.responses.JSONResponse(
-        results,
+        {
+            "reviews": items,
+            "next": next_before,
+        },
         status_code=200,
     )
 
 
 @router.get("/full/{id}")
-async def full_request(id: int, ts: int):
+async def full_request(
+    request: fastapi.Request,
+    id: int,
+    ts: int,
+    since: int | None = None,
+    fields: str | None = None,
+):
     if id not in VALID_THREAD_IDS:
         return fastapi.responses.JSONResponse(
             "Invalid thread ID",
@@ -56,22 +125,227 @@ async def full_request(id: int, ts: int):
 
     # Use timestamps for dynamic cache, but
     # prevent abuse from caching future timestamps
-    if ts > time.time():
+    if ts > time.time() or (since or 0) > time.time():
         return fastapi.responses.JSONResponse(
             "Invalid timestamp",
             status_code=406,
         )
 
-    full = await cache.get_thread(id)
+    if since is None and not fields:
+        # Full thread is stored ready to send, skip all processing
+        encoding = preferred_encoding(request)
+        body, revision, index_error, cache_status = await cache.get_thread_body(
+            id, encoding, client_address(request)
+        )
+        if cache_status == cache.STATUS_SHED:
+            return shed_response()
+        status = full_status({cache.INDEX_ERROR: index_error})
+        headers = {
+            "ETag": etag(revision, since, fields, encoding),
+            "Vary": "Accept-Encoding",
+            cache.STATUS_HEADER: cache_status,
+        }
+        if encoding != cache.BODY_IDENTITY:
+            headers["Content-Encoding"] = encoding
+        if status == 200 and not_modified(request, headers["ETag"]):
+            return fastapi.responses.Response(status_code=304, headers=headers)
+
+        return fastapi.responses.Response(
+            body,
+            status_code=status,
+            headers=headers,
+            media_type="application/json",
+        )
+
+    if fields:
+        fields = fields.split(",")
+
+    full, cache_status, revision = await cache.get_thread(
+        id, since, fields, client_address(request)
+    )
+    if cache_status == cache.STATUS_SHED:
+        return shed_response()
+
+    status = full_status(full)
+    headers = {
+        "ETag": etag(revision, since, fields, cache.BODY_IDENTITY),
+        cache.STATUS_HEADER: cache_status,
+    }
+    if status == 200 and not_modified(request, headers["ETag"]):
+        return fastapi.responses.Response(status_code=304, headers=headers)
+
+    return fastapi.responses.JSONResponse(
+        full,
+        status_code=status,
+        headers=headers,
+    )
+
+
+@router.get("/full")
+async def full_bulk_request(
+    request: fastapi.Request, ids: str, fields: str | None = None
+):
+    ids = ids.split(",")
+    if len(ids) > FULL_MAX_IDS:
+        return fastapi.responses.JSONResponse(
+            f"Max {FULL_MAX_IDS} IDs",
+            status_code=400,
+        )
+
+    # Each ID comes with its own timestamp for dynamic cache, and
+    # optionally a timestamp for delta responses, formatted as id:ts[:since]
+    queries = {}
+    try:
+        for query in ids:
+            if not query:
+                continue
+            id, ts, *since = map(int, query.split(":"))
+            if len(since) > 1:
+                raise ValueError()
+            queries[id] = (ts, since[0] if since else None)
+    except ValueError:
+        return fastapi.responses.JSONResponse(
+            "IDs and timestamps must be numeric",
+            status_code=400,
+        )
+
+    if any(id not in VALID_THREAD_IDS for id in queries):
+        return fastapi.responses.JSONResponse(
+            "Invalid thread IDs",
+            status_code=400,
+        )
+
+    if any(
+        ts > time.time() or (since or 0) > time.time() for ts, since in queries.values()
+    ):
+        return fastapi.responses.JSONResponse(
+            "Invalid timestamps",
+            status_code=406,
+        )
+
+    if fields:
+        fields = fields.split(",")
+    client = client_address(request)
+
+    async def get_thread_line(id: int) -> bytes:
+        since = queries[id][1]
+        try:
+            if since is None and not fields:
+                # Embed the stored body as is, instead of serializing again
+                body, _, index_error, cache_status = await cache.get_thread_body(
+                    id, cache.BODY_IDENTITY, client
+                )
+                if cache_status == cache.STATUS_SHED:
+                    return shed_line(id)
+                line = {
+                    "id": id,
+                    "status": full_status({cache.INDEX_ERROR: index_error}),
+                    "cache": cache_status,
+                }
+                return json.dumps(line)[:-1].encode() + b', "thread": ' + body + b"}\n"
+            full, cache_status, _ = await cache.get_thread(id, since, fields, client)
+            if cache_status == cache.STATUS_SHED:
+                return shed_line(id)
+        except Exception:
+            logger.error(f"Exception getting {id}: {error.text()}\n{error.traceback()}")
+            full = {cache.INDEX_ERROR: f95zone.ERROR_INTERNAL_ERROR.error_flag}
+            cache_status = cache.STATUS_FRESH
+        line = {
+            "id": id,
+            "status": full_status(full),
+            "cache": cache_status,
+            "thread": full,
+        }
+        return json.dumps(line).encode() + b"\n"
+
+    # Stream each thread as soon as it's ready, one JSON object per line
+    # No ETag, it would have to wait for all threads, and clients only ask for
+    # threads that changed since their last full check, with since for deltas
+    async def stream_threads():
+        tasks = [asyncio.create_task(get_thread_line(id)) for id in queries]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
 
-    status = 200
+    return fastapi.responses.StreamingResponse(
+        stream_threads(),
+        status_code=200,
+        media_type="application/x-ndjson",
+    )
+
+
+def full_status(full: dict[str, str]) -> int:
     if index_error := full.get(cache.INDEX_ERROR):
         if index_error == f95zone.ERROR_THREAD_MISSING.error_flag:
-            status = 404
+            return 404
         else:
-            status = 500
+            return 500
+    return 200
+
 
+def client_address(request: fastapi.Request) -> str:
+    # Behind a reverse proxy, it passes the real address in a header
+    # Clients can send their own X-Forwarded-For, so only trust what the proxy
+    # appended last
+    if cache.client_header and (address := request.headers.get(cache.client_header)):
+        return address.split(",")[-1].strip()
+    return request.client.host if request.client else ""
+
+
+def shed_response() -> fastapi.responses.JSONResponse:
     return fastapi.responses.JSONResponse(
-        full,
-        status_code=status,
+        "Too many uncached threads, try again later",
+        status_code=429,
+        headers={"Retry-After": retry_after()},
+    )
+
+
+def retry_after() -> str:
+    # Time for the client's budget to allow another scrape
+    return str(math.ceil(cache.ADMISSION_PERIOD / cache.admission_scrapes))
+
+
+def shed_line(id: int) -> bytes:
+    line = {
+        "id": id,
+        "status": 429,
+        "cache": cache.STATUS_SHED,
+        "thread": {},
+    }
+    return json.dumps(line).encode() + b"\n"
+
+
+def etag(*parts) -> str:
+    return f'"{hashlib.md5(json.dumps(parts).encode()).hexdigest()}"'
+
+
+def not_modified(request: fastapi.Request, etag: str) -> bool:
+    if not (if_none_match := request.headers.get("If-None-Match")):
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, proxies might weaken our tags when compressing
+    etag = etag.removeprefix("W/")
+    return any(
+        tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(",")
     )
+
+
+def preferred_encoding(request: fastapi.Request) -> str:
+    accepted = {}
+    for coding in request.headers.get("Accept-Encoding", "").split(","):
+        coding, _, params = coding.partition(";")
+        quality = 1.0
+        if (params := params.strip()).startswith("q="):
+            try:
+                quality = float(params.removeprefix("q="))
+            except ValueError:
+                pass
+        accepted[coding.strip().lower()] = quality
+    for encoding in (cache.BODY_ZSTD, cache.BODY_GZIP):
+        if accepted.get(encoding, 0) > 0:
+            return encoding
+    return cache.BODY_IDENTITY
@@ -0,0 +1,237 @@
+import collections
+import contextlib
+import contextvars
+import dataclasses
+import heapq
+import json
+import logging
+import os
+import pathlib
+import random
+import secrets
+import time
+
+import zstandard
+
+from external import error
+from indexer import metrics
+
+# Every scrape is traced, only a sample is kept as recent, but the slowest
+# and failed ones are always kept
+TRACE_DEFAULT_SAMPLE_RATE = 0.05
+TRACE_RECENT_SIZE = 200
+TRACE_SLOWEST_SIZE = 20
+TRACE_FAILURES_SIZE = 20
+TRACE_DUMP_LEVEL = 10
+
+logger = logging.getLogger(__name__)
+sample_rate = TRACE_DEFAULT_SAMPLE_RATE
+trace_dir: pathlib.Path | None = None
+current: contextvars.ContextVar["Trace | None"] = contextvars.ContextVar(
+    "trace", default=None
+)
+recent: collections.deque["Trace"] = collections.deque(maxlen=TRACE_RECENT_SIZE)
+slowest: list[tuple[float, str, "Trace"]] = []  # Heap, fastest first
+failures: collections.deque["Trace"] = collections.deque(maxlen=TRACE_FAILURES_SIZE)
+
+
+@dataclasses.dataclass(slots=True)
+class Span:
+    name: str
+    start: float
+    end: float
+    attributes: dict[str, str | int | float]
+    id: str = dataclasses.field(default_factory=lambda: secrets.token_hex(8))
+
+
+@dataclasses.dataclass(slots=True)
+class Trace:
+    thread: int
+    start: float
+    end: float = 0.0
+    result: str = "exception"
+    spans: list[Span] = dataclasses.field(default_factory=list)
+    dumps: dict[str, bytes] = dataclasses.field(default_factory=dict)
+    id: str = dataclasses.field(default_factory=lambda: secrets.token_hex(16))
+    span_id: str = dataclasses.field(default_factory=lambda: secrets.token_hex(8))
+
+
+@contextlib.asynccontextmanager
+async def lifespan():
+    global sample_rate, trace_dir
+    sample_rate = float(
+        os.environ.get("TRACE_SAMPLE_RATE") or TRACE_DEFAULT_SAMPLE_RATE
+    )
+    if path := os.environ.get("TRACE_DIR"):
+        trace_dir = pathlib.Path(path)
+        trace_dir.mkdir(parents=True, exist_ok=True)
+
+    try:
+        yield
+    finally:
+
+        # Scrape-only processes have no API to export from, so leave a file
+        if trace_dir and (traces := retained()):
+            _write(f"traces-{os.getpid()}-{int(time.time())}.json", to_otlp(traces))
+
+
+@contextlib.contextmanager
+def trace(thread: int):
+    trace = Trace(thread=thread, start=time.time())
+    token = current.set(trace)
+    try:
+        yield trace
+    finally:
+        current.reset(token)
+        trace.end = time.time()
+        _retain(trace)
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes: str | int | float):
+    # Yields attributes, to add what is only known once it's done
+    start = time.time()
+    try:
+        yield attributes
+    finally:
+        record(name, start, time.time(), **attributes)
+
+
+@contextlib.contextmanager
+def step(name: str):
+    # Scrape steps are also measured across all scrapes in metrics
+    with span(name):
+        with metrics.SCRAPE_STEP_SECONDS.time(name):
+            yield
+
+
+def record(name: str, start: float, end: float, **attributes: str | int | float):
+    if trace := current.get():
+        trace.spans.append(Span(name, start, end, attributes))
+
+
+def dump(name: str, data: bytes | str) -> str:
+    # Returns the trace ID to point to in logs
+    if not (trace := current.get()):
+        return ""
+    if isinstance(data, str):
+        data = data.encode()
+    trace.dumps[name] = zstandard.compress(data, TRACE_DUMP_LEVEL)
+    return trace.id
+
+
+def retained() -> list[Trace]:
+    traces = {}
+    for trace in (*recent, *(trace for _, _, trace in slowest), *failures):
+        traces[trace.id] = trace
+    return list(traces.values())
+
+
+def find(id: str) -> Trace | None:
+    for trace in retained():
+        if trace.id == id:
+            return trace
+    return None
+
+
+def to_json(trace: Trace) -> dict:
+    return {
+        "id": trace.id,
+        "thread": trace.thread,
+        "start": trace.start,
+        "duration": trace.end - trace.start,
+        "result": trace.result,
+        "spans": [
+            {
+                "name": span.name,
+                "offset": span.start - trace.start,
+                "duration": span.end - span.start,
+                "attributes": span.attributes,
+            }
+            for span in trace.spans
+        ],
+        "dumps": list(trace.dumps),
+    }
+
+
+def to_otlp(traces: list[Trace]) -> dict:
+    # https://opentelemetry.io/docs/specs/otlp/#json-protobuf-encoding
+    def otlp_span(trace: Trace, span: Span | None) -> dict:
+        item = span or Span("scraper.thread", trace.start, trace.end, {})
+        attributes = dict(item.attributes)
+        if span is None:
+            attributes.update(thread=trace.thread, result=trace.result)
+        return {
+            "traceId": trace.id,
+            "spanId": span.id if span else trace.span_id,
+            **({"parentSpanId": trace.span_id} if span else {}),
+            "name": item.name,
+            "kind": 1,
+            "startTimeUnixNano": str(int(item.start * 1e9)),
+            "endTimeUnixNano": str(int(item.end * 1e9)),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in attributes.items()
+            ],
+        }
+
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {"key": "service.name", "value": _otlp_value("indexer")}
+                    ]
+                },
+                "scopeSpans": [
+                    {
+                        "scope": {"name": __name__},
+                        "spans": [
+                            otlp_span(trace, span)
+                            for trace in traces
+                            for span in (None, *trace.spans)
+                        ],
+                    }
+                ],
+            }
+        ]
+    }
+
+
+def _retain(trace: Trace) -> None:
+    if random.random() < sample_rate:
+        recent.append(trace)
+
+    duration = trace.end - trace.start
+    if len(slowest) < TRACE_SLOWEST_SIZE:
+        heapq.heappush(slowest, (duration, trace.id, trace))
+    elif duration > slowest[0][0]:
+        heapq.heapreplace(slowest, (duration, trace.id, trace))
+
+    if trace.dumps:
+        failures.append(trace)
+        if trace_dir:
+            _write(f"{trace.id}.json", to_otlp([trace]))
+            for name, data in trace.dumps.items():
+                _write(f"{trace.id}-{name}.zst", data)
+
+
+def _write(filename: str, data: dict | bytes) -> None:
+    try:
+        if isinstance(data, dict):
+            data = json.dumps(data).encode()
+        (trace_dir / filename).write_bytes(data)
+    except Exception:
+        logger.error(
+            f"Error writing trace {filename}: {error.text()}\n{error.traceback()}"
+        )
+
+
+def _otlp_value(value: str | int | float) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
@@ -0,0 +1,95 @@
+import asyncio
+import itertools
+import json
+import logging
+
+from indexer import f95zone
+
+VERSIONS_BATCH_SIZE = 1000  # Same as watcher chunks
+
+logger = logging.getLogger(__name__)
+pending: dict[int, list[asyncio.Future]] = {}
+flush_task: asyncio.Task = None
+lookup_tasks: set[asyncio.Task] = set()
+
+
+async def lookup(id: int) -> str | f95zone.IndexerError:
+    # Lookups from concurrent scrapes are sent together in one request
+    global flush_task
+    future = asyncio.get_running_loop().create_future()
+    pending.setdefault(id, []).append(future)
+    if flush_task is None:
+        flush_task = asyncio.create_task(_flush())
+    return await future
+
+
+async def _flush() -> None:
+    # Each batch is everything that piled up while waiting for the ratelimit,
+    # the next one starts waiting while the previous request is in flight
+    global flush_task
+    try:
+        while pending:
+            await f95zone.RATELIMIT.acquire()
+            batch = dict(itertools.islice(pending.items(), VERSIONS_BATCH_SIZE))
+            for id in batch:
+                del pending[id]
+            task = asyncio.create_task(_lookup_batch(batch))
+            lookup_tasks.add(task)
+            task.add_done_callback(lookup_tasks.discard)
+    except Exception as exc:
+        for futures in pending.values():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(exc)
+        pending.clear()
+    finally:
+        flush_task = None
+
+
+async def _lookup_batch(batch: dict[int, list[asyncio.Future]]) -> None:
+    try:
+        versions = await _fetch_versions(list(batch))
+    except Exception as exc:
+        for futures in batch.values():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(exc)
+        return
+
+    for id, futures in batch.items():
+        if isinstance(versions, f95zone.IndexerError):
+            version = versions
+        else:
+            version = versions.get(str(id), "")
+            if version == "Unknown":
+                version = ""
+        for future in futures:
+            if not future.done():
+                future.set_result(version)
+
+
+async def _fetch_versions(ids: list[int]) -> dict[str, str] | f95zone.IndexerError:
+    logger.debug(f"Lookup versions for {len(ids)} threads")
+    try:
+        # Ratelimit was already waited for by _flush()
+        async with f95zone.session.get(
+            f95zone.VERCHK_URL.format(threads=",".join(str(id) for id in ids)),
+        ) as req:
+            res = await req.read()
+    except Exception as exc:
+        if index_error := f95zone.check_error(exc, logger):
+            return index_error
+        raise
+    if index_error := f95zone.check_error(res, logger):
+        return index_error
+    try:
+        versions = json.loads(res)
+    except Exception:
+        logger.error(f"Versions API returned invalid JSON: {res}")
+        return f95zone.ERROR_UNKNOWN_RESPONSE
+    if versions.get("msg") in ("Missing threads data", "Thread not found"):
+        versions["status"] = "ok"
+        versions["msg"] = {}
+    if index_error := f95zone.check_error(versions, logger):
+        return index_error
+    return versions["msg"]
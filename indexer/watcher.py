@@ -1,4 +1,5 @@
 import asyncio
+import collections
 import contextlib
 import datetime as dt
 import hashlib
@@ -6,18 +7,28 @@ import json
 import logging
 import time
 
+import redis.asyncio as aredis
+
 from common import parser
 from external import error
 from indexer import (
     cache,
+    distributed,
     f95zone,
+    latest,
+    metrics,
 )
 
-WATCH_UPDATES_INTERVAL = dt.timedelta(minutes=5).total_seconds()
+WATCH_UPDATES_INTERVAL = dt.timedelta(minutes=2).total_seconds()
 WATCH_UPDATES_CATEGORIES = f95zone.LATEST_CATEGORIES
 WATCH_UPDATES_PAGES = 4
+WATCH_UPDATES_BACKFILL_PAGES = 2
+WATCH_UPDATES_NEWEST = "watch:updates:newest"
+WATCH_UPDATES_BACKFILL = "watch:updates:backfill"
 WATCH_VERSIONS_INTERVAL = dt.timedelta(hours=12).total_seconds()
 WATCH_VERSIONS_CHUNK_SIZE = 1000
+WATCH_VERSIONS_IN_FLIGHT = 4
+WATCH_VERSIONS_CURSOR = "watch:versions:cursor"
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +36,7 @@ logger = logging.getLogger(__name__)
 @contextlib.asynccontextmanager
 async def lifespan():
     updates_task = asyncio.create_task(watch_updates())
+    build_latest_task = asyncio.create_task(build_latest_index())
     versions_task = asyncio.create_task(watch_versions())
 
     try:
@@ -32,13 +44,68 @@ async def lifespan():
     finally:
 
         updates_task.cancel()
+        build_latest_task.cancel()
         versions_task.cancel()
 
 
-# https://stackoverflow.com/a/312464
-def chunks(lst, n):
-    for i in range(0, len(lst), n):
-        yield lst[i : i + n]
+async def fetch_latest(category: str, page: int) -> dict:
+    try:
+        async with f95zone.RATELIMIT, f95zone.session.get(
+            f95zone.LATEST_URL.format(
+                cmd="list",
+                cat=category,
+                page=page,
+                sort="date",
+                rows=90,
+                ts=int(time.time()),
+            ),
+            cookies=f95zone.cookies,
+        ) as req:
+            res = await req.read()
+    except Exception as exc:
+        if index_error := f95zone.check_error(exc, logger):
+            raise Exception(index_error)
+        raise
+
+    if index_error := f95zone.check_error(res, logger):
+        raise Exception(index_error)
+
+    try:
+        updates = json.loads(res)
+    except Exception:
+        raise Exception(f"Latest updates returned invalid JSON: {res}")
+    if index_error := f95zone.check_error(updates, logger):
+        raise Exception(index_error)
+    return updates
+
+
+async def build_latest_index():
+    await asyncio.sleep(10)
+
+    # Only one worker crawls, the others wait for it to finish then skip
+    async with distributed.lock("build_latest_index"):
+        while not await latest.is_built():
+            logger.info("Build latest updates index start")
+            try:
+                for category in f95zone.LATEST_CATEGORIES:
+                    page = 1
+                    while True:
+                        updates = await fetch_latest(category, page)
+                        await latest.store(updates["msg"]["data"])
+                        pagination = updates["msg"].get("pagination", {})
+                        if not updates["msg"]["data"] or page >= pagination.get(
+                            "total", 0
+                        ):
+                            break
+                        page += 1
+                    logger.info(f"Build latest updates index: {category} {page} pages")
+                await latest.mark_built()
+                logger.info("Build latest updates index done")
+            except Exception:
+                logger.error(
+                    f"Error building latest updates index: {error.text()}\n{error.traceback()}"
+                )
+                await asyncio.sleep(WATCH_UPDATES_INTERVAL)
 
 
 async def watch_updates():
@@ -46,108 +113,57 @@ async def watch_updates():
 
     while True:
         try:
-            async with asyncio.timeout(f95zone.TIMEOUT.total):
+            # Only one worker polls in each interval
+            if wait := await distributed.claim("watch_updates", WATCH_UPDATES_INTERVAL):
+                await asyncio.sleep(wait)
+                continue
+
+            # Requests wait for the shared ratelimit, so allow the whole interval
+            async with asyncio.timeout(WATCH_UPDATES_INTERVAL):
                 logger.info("Poll updates start")
+                start = time.perf_counter()
 
                 invalidate_cache = cache.redis.pipeline()
-
-                for category in WATCH_UPDATES_CATEGORIES:
-                    for page in range(1, WATCH_UPDATES_PAGES + 1):
-                        logger.info(f"Poll category {category} page {page}")
-
-                        cached_data = cache.redis.pipeline()
-
-                        try:
-                            async with f95zone.session.get(
-                                f95zone.LATEST_URL.format(
-                                    cmd="list",
-                                    cat=category,
-                                    page=page,
-                                    sort="date",
-                                    rows=90,
-                                    ts=int(time.time()),
-                                ),
-                                cookies=f95zone.cookies,
-                            ) as req:
-                                res = await req.read()
-                        except Exception as exc:
-                            if index_error := f95zone.check_error(exc, logger):
-                                raise Exception(index_error)
-                            raise
-
-                        if index_error := f95zone.check_error(res, logger):
-                            raise Exception(index_error)
-
-                        try:
-                            updates = json.loads(res)
-                        except Exception:
-                            raise Exception(
-                                f"Latest updates returned invalid JSON: {res}"
-                            )
-                        if index_error := f95zone.check_error(updates, logger):
-                            raise Exception(index_error)
-
-                        # We compare version strings to detect updates
-                        # But also make a hash of other attributes to detect metadata changes
-                        # We don't save these values directly because we parse from thread content instead
-                        # But using this meta hash allows to discover metadata changes sooner
-                        names = []
-                        current_data = []
-                        for update in updates["msg"]["data"]:
-                            name = cache.NAME_FORMAT.format(id=update["thread_id"])
-                            names.append(name)
-                            cached_data.hmget(
-                                name, "version", cache.HASHED_META, cache.LAST_CACHED
-                            )
-                            version = update["version"]
-                            if version == "Unknown":
-                                version = None
-                            meta = (
-                                update["title"],
-                                update["creator"],
-                                update["prefixes"],
-                                update["tags"],
-                                round(update["rating"], 1),
-                                update["cover"],
-                                update["screens"],
-                                parser.datestamp(update["ts"]),
-                            )
-                            meta = hashlib.md5(json.dumps(meta).encode()).hexdigest()
-                            current_data.append((version, meta))
-
-                        cached_data = await cached_data.execute()
-
-                        assert len(names) == len(current_data) == len(cached_data)
-                        for (
-                            name,
-                            (version, meta),
-                            (cached_version, cached_meta, last_cached),
-                        ) in zip(names, current_data, cached_data):
-                            if cached_version is None or not last_cached:
-                                continue
-
-                            version_outdated = version and version != cached_version
-                            meta_outdated = meta != cached_meta
-
-                            if version_outdated or meta_outdated:
-                                invalidate_cache.hdel(name, cache.LAST_CACHED)
-                                invalidate_cache.hset(name, cache.HASHED_META, meta)
-                                logger.info(
-                                    f"Updates: Invalidating cache for {name}"
-                                    + (
-                                        f" ({cached_version!r} -> {version!r})"
-                                        if version_outdated
-                                        else " (meta changed)"
-                                    )
-                                )
+                newest = await cache.redis.hgetall(WATCH_UPDATES_NEWEST)
+
+                # Categories share the ratelimit, so no harm in crawling them together
+                polled = await asyncio.gather(
+                    *(
+                        poll_category(
+                            category, int(newest.get(category, 0)), invalidate_cache
+                        )
+                        for category in WATCH_UPDATES_CATEGORIES
+                    )
+                )
+                # Nothing left to catch up on, use spare time to crawl deeper
+                if all(caught_up for _, caught_up in polled):
+                    await asyncio.gather(
+                        *(
+                            backfill_category(category, invalidate_cache)
+                            for category in WATCH_UPDATES_CATEGORIES
+                        )
+                    )
 
                 if len(invalidate_cache):
                     result = await invalidate_cache.execute()
-                    # Skip every 2nd result, those are setting HASHED_META
-                    invalidated = sum(ret != "0" for ret in result[::2])
+                    # Only count HDEL results, skip the other commands per thread
+                    invalidated = sum(bool(deleted) for deleted in result[::4])
                     logger.info(f"Updates: Invalidated cache for {invalidated} threads")
+                    metrics.WATCHER_INVALIDATIONS.inc("updates", amount=invalidated)
+
+                # Only move on once invalidations are saved
+                newest = {
+                    category: newest_ts
+                    for category, (newest_ts, _) in zip(
+                        WATCH_UPDATES_CATEGORIES, polled
+                    )
+                    if newest_ts
+                }
+                if newest:
+                    await cache.redis.hset(WATCH_UPDATES_NEWEST, mapping=newest)
 
                 logger.info("Poll updates done")
+                metrics.WATCHER_SECONDS.observe(time.perf_counter() - start, "updates")
 
         except Exception as exc:
             if (
@@ -157,12 +173,12 @@ async def watch_updates():
             ):
                 index_error = exc.args[0]
             else:
-                index_error = f95zone.check_error(exc)
+                index_error = f95zone.check_error(exc, logger)
 
             if index_error:
-                await asyncio.sleep(
-                    min(index_error.retry_delay, WATCH_UPDATES_INTERVAL)
-                )
+                retry_delay = min(index_error.retry_delay, WATCH_UPDATES_INTERVAL)
+                await distributed.reclaim("watch_updates", retry_delay)
+                await asyncio.sleep(retry_delay)
                 continue
             else:
                 logger.error(
@@ -172,86 +188,134 @@ async def watch_updates():
         await asyncio.sleep(WATCH_UPDATES_INTERVAL)
 
 
+async def poll_category(
+    category: str, newest_ts: int, invalidate_cache: aredis.client.Pipeline
+) -> tuple[int, bool]:
+    # Pages are sorted by date, stop once we reach rows seen in the last poll
+    seen_ts = newest_ts
+    for page in range(1, WATCH_UPDATES_PAGES + 1):
+        logger.info(f"Poll category {category} page {page}")
+
+        updates = await fetch_latest(category, page)
+        rows = updates["msg"]["data"]
+        await check_updates(rows, invalidate_cache)
+        if not rows:
+            return newest_ts, True
+
+        newest_ts = max(newest_ts, *(update["ts"] for update in rows))
+        if min(update["ts"] for update in rows) <= seen_ts:
+            return newest_ts, True
+
+    return newest_ts, False
+
+
+async def backfill_category(
+    category: str, invalidate_cache: aredis.client.Pipeline
+) -> None:
+    # Walk deeper pages a few at a time, starting over when reaching the end
+    page = int(
+        await cache.redis.hget(WATCH_UPDATES_BACKFILL, category)
+        or WATCH_UPDATES_PAGES + 1
+    )
+    for _ in range(WATCH_UPDATES_BACKFILL_PAGES):
+        logger.info(f"Backfill category {category} page {page}")
+
+        updates = await fetch_latest(category, page)
+        rows = updates["msg"]["data"]
+        await check_updates(rows, invalidate_cache)
+
+        pagination = updates["msg"].get("pagination", {})
+        if rows and page < pagination.get("total", 0):
+            page += 1
+        else:
+            page = WATCH_UPDATES_PAGES + 1
+            break
+
+    await cache.redis.hset(WATCH_UPDATES_BACKFILL, category, page)
+
+
+async def check_updates(
+    rows: list[dict], invalidate_cache: aredis.client.Pipeline
+) -> None:
+    await latest.store(rows)
+    if rows:
+        # New threads show up here first, so IDs up to these exist
+        await cache.redis.zadd(
+            cache.TOP_ID_INDEX,
+            {cache.TOP_ID_MEMBER: max(update["thread_id"] for update in rows)},
+            gt=True,
+        )
+
+    # We compare version strings to detect updates
+    # But also make a hash of other attributes to detect metadata changes
+    # We don't save these values directly because we parse from thread content instead
+    # But using this meta hash allows to discover metadata changes sooner
+    cached_data = cache.redis.pipeline()
+    names = []
+    current_data = []
+    for update in rows:
+        name = cache.NAME_FORMAT.format(id=update["thread_id"])
+        names.append(name)
+        cached_data.hmget(name, "version", cache.HASHED_META, cache.LAST_CACHED)
+        version = update["version"]
+        if version == "Unknown":
+            version = None
+        meta = (
+            update["title"],
+            update["creator"],
+            update["prefixes"],
+            update["tags"],
+            round(update["rating"], 1),
+            update["cover"],
+            update["screens"],
+            parser.datestamp(update["ts"]),
+        )
+        meta = hashlib.md5(json.dumps(meta).encode()).hexdigest()
+        current_data.append((version, meta))
+
+    cached_data = await cached_data.execute()
+
+    assert len(names) == len(current_data) == len(cached_data)
+    for (
+        name,
+        (version, meta),
+        (cached_version, cached_meta, last_cached),
+    ) in zip(names, current_data, cached_data):
+        if cached_version is None or not last_cached:
+            continue
+
+        version_outdated = version and version != cached_version
+        meta_outdated = meta != cached_meta
+
+        if version_outdated or meta_outdated:
+            invalidate_cache.hdel(name, cache.LAST_CACHED)
+            invalidate_cache.hset(name, cache.HASHED_META, meta)
+            invalidate_cache.zadd(cache.EXPIRE_INDEX, {name.split(":")[1]: 0})
+            cache.invalidate(invalidate_cache, name.split(":")[1])
+            logger.info(
+                f"Updates: Invalidating cache for {name}"
+                + (
+                    f" ({cached_version!r} -> {version!r})"
+                    if version_outdated
+                    else " (meta changed)"
+                )
+            )
+
+
 async def watch_versions():
     await asyncio.sleep(20)
 
     while True:
         try:
-            async with asyncio.timeout(f95zone.TIMEOUT.total):
-                logger.info("Poll versions start")
-
-                names = [
-                    n async for n in cache.redis.scan_iter("thread:*", 10000, "hash")
-                ]
-                invalidate_cache = cache.redis.pipeline()
-
-                for names_chunk in chunks(names, WATCH_VERSIONS_CHUNK_SIZE):
-
-                    cached_data = cache.redis.pipeline()
-                    csv = ""
-                    ids = []
-                    for name in names_chunk:
-                        cached_data.hmget(name, "version", cache.LAST_CACHED)
-                        id = name.split(":")[1]
-                        csv += f"{id},"
-                        ids.append(id)
-                    csv = csv.strip(",")
-
-                    try:
-                        async with f95zone.session.get(
-                            f95zone.VERCHK_URL.format(threads=csv),
-                        ) as req:
-                            # Await together for efficiency
-                            res, cached_data = await asyncio.gather(
-                                req.read(), cached_data.execute()
-                            )
-                    except Exception as exc:
-                        if index_error := f95zone.check_error(exc, logger):
-                            raise Exception(index_error)
-                        raise
-
-                    if index_error := f95zone.check_error(res, logger):
-                        raise Exception(index_error)
-
-                    try:
-                        versions = json.loads(res)
-                    except Exception:
-                        raise Exception(f"Versions API returned invalid JSON: {res}")
-                    if versions.get("msg") in (
-                        "Missing threads data",
-                        "Thread not found",
-                    ):
-                        versions["status"] = "ok"
-                        versions["msg"] = {}
-                    if index_error := f95zone.check_error(versions, logger):
-                        raise Exception(index_error)
-                    versions = versions["msg"]
-
-                    assert len(names_chunk) == len(ids) == len(cached_data)
-                    for name, id, (cached_version, last_cached) in zip(
-                        names_chunk, ids, cached_data
-                    ):
-                        if cached_version is None or not last_cached:
-                            continue
-                        version = versions.get(id)
-                        if not version or version == "Unknown":
-                            continue
-
-                        if version != cached_version:
-                            invalidate_cache.hdel(name, cache.LAST_CACHED)
-                            logger.warning(
-                                f"Versions: Invalidating cache for {name}"
-                                f" ({cached_version!r} -> {version!r})"
-                            )
-
-                if len(invalidate_cache):
-                    result = await invalidate_cache.execute()
-                    invalidated = sum(ret != "0" for ret in result)
-                    logger.warning(
-                        f"Versions: Invalidated cache for {invalidated} threads"
-                    )
+            # Only one worker polls in each interval
+            if wait := await distributed.claim(
+                "watch_versions", WATCH_VERSIONS_INTERVAL
+            ):
+                await asyncio.sleep(wait)
+                continue
 
-                logger.info("Poll versions done")
+            async with asyncio.timeout(WATCH_VERSIONS_INTERVAL):
+                await sweep_versions()
 
         except Exception as exc:
             if (
@@ -261,12 +325,12 @@ async def watch_versions():
             ):
                 index_error = exc.args[0]
             else:
-                index_error = f95zone.check_error(exc)
+                index_error = f95zone.check_error(exc, logger)
 
             if index_error:
-                await asyncio.sleep(
-                    min(index_error.retry_delay, WATCH_VERSIONS_INTERVAL)
-                )
+                retry_delay = min(index_error.retry_delay, WATCH_VERSIONS_INTERVAL)
+                await distributed.reclaim("watch_versions", retry_delay)
+                await asyncio.sleep(retry_delay)
                 continue
             else:
                 logger.error(
@@ -274,3 +338,120 @@ async def watch_versions():
                 )
 
         await asyncio.sleep(WATCH_VERSIONS_INTERVAL)
+
+
+async def sweep_versions():
+    # Resume where the last sweep stopped, if it didn't finish
+    cursor = int(await cache.redis.get(WATCH_VERSIONS_CURSOR) or 0)
+    logger.info("Poll versions " + (f"resume at {cursor}" if cursor else "start"))
+    sweep_start = time.perf_counter()
+
+    invalidated = 0
+    in_flight = collections.deque()
+    buffer = []  # Names with the cursor their scan started at
+
+    async def settle_oldest():
+        nonlocal invalidated
+        task, checkpoint = in_flight.popleft()
+        chunk_invalidated = await task
+        invalidated += chunk_invalidated
+        metrics.WATCHER_INVALIDATIONS.inc("versions", amount=chunk_invalidated)
+        # All names before this cursor were checked
+        await cache.redis.set(WATCH_VERSIONS_CURSOR, checkpoint)
+
+    try:
+        while True:
+            start = cursor
+            cursor, names = await cache.redis.scan(
+                cursor, match="thread:*", count=WATCH_VERSIONS_CHUNK_SIZE, _type="hash"
+            )
+            buffer.extend((name, start) for name in names)
+
+            while len(buffer) >= WATCH_VERSIONS_CHUNK_SIZE or (cursor == 0 and buffer):
+                chunk = buffer[:WATCH_VERSIONS_CHUNK_SIZE]
+                buffer = buffer[WATCH_VERSIONS_CHUNK_SIZE:]
+                checkpoint = buffer[0][1] if buffer else cursor
+                task = asyncio.create_task(check_versions([name for name, _ in chunk]))
+                in_flight.append((task, checkpoint))
+                while len(in_flight) >= WATCH_VERSIONS_IN_FLIGHT:
+                    await settle_oldest()
+
+            if cursor == 0:
+                break
+
+        while in_flight:
+            await settle_oldest()
+    finally:
+
+        for task, _ in in_flight:
+            task.cancel()
+
+    await cache.redis.delete(WATCH_VERSIONS_CURSOR)
+    if invalidated:
+        logger.warning(f"Versions: Invalidated cache for {invalidated} threads")
+    logger.info("Poll versions done")
+    metrics.WATCHER_SECONDS.observe(time.perf_counter() - sweep_start, "versions")
+
+
+async def check_versions(names: list[str]) -> int:
+    cached_data = cache.redis.pipeline()
+    csv = ""
+    ids = []
+    for name in names:
+        cached_data.hmget(name, "version", cache.LAST_CACHED)
+        id = name.split(":")[1]
+        csv += f"{id},"
+        ids.append(id)
+    csv = csv.strip(",")
+
+    try:
+        async with f95zone.RATELIMIT, f95zone.session.get(
+            f95zone.VERCHK_URL.format(threads=csv),
+        ) as req:
+            # Await together for efficiency
+            res, cached_data = await asyncio.gather(req.read(), cached_data.execute())
+    except Exception as exc:
+        if index_error := f95zone.check_error(exc, logger):
+            raise Exception(index_error)
+        raise
+
+    if index_error := f95zone.check_error(res, logger):
+        raise Exception(index_error)
+
+    try:
+        versions = json.loads(res)
+    except Exception:
+        raise Exception(f"Versions API returned invalid JSON: {res}")
+    if versions.get("msg") in (
+        "Missing threads data",
+        "Thread not found",
+    ):
+        versions["status"] = "ok"
+        versions["msg"] = {}
+    if index_error := f95zone.check_error(versions, logger):
+        raise Exception(index_error)
+    versions = versions["msg"]
+
+    invalidate_cache = cache.redis.pipeline()
+    assert len(names) == len(ids) == len(cached_data)
+    for name, id, (cached_version, last_cached) in zip(names, ids, cached_data):
+        if cached_version is None or not last_cached:
+            continue
+        version = versions.get(id)
+        if not version or version == "Unknown":
+            continue
+
+        if version != cached_version:
+            invalidate_cache.hdel(name, cache.LAST_CACHED)
+            invalidate_cache.zadd(cache.EXPIRE_INDEX, {id: 0})
+            cache.invalidate(invalidate_cache, id)
+            logger.warning(
+                f"Versions: Invalidating cache for {name}"
+                f" ({cached_version!r} -> {version!r})"
+            )
+
+    if not len(invalidate_cache):
+        return 0
+    result = await invalidate_cache.execute()
+    # Only count HDEL results, skip expire index and publish
+    return sum(bool(deleted) for deleted in result[::3])
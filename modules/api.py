@@ -39,6 +39,7 @@ from common.structs import (
     Status,
     Tag,
     TimelineEventType,
+    Timestamp,
     Type,
 )
 from common import parser
@@ -101,8 +102,12 @@ f95_temp_error_messages = (
 
 api_host = os.environ.get("F95INDEXER_URL") or "https://api.f95checker.dev"
 api_fast_check_url = api_host + "/fast?ids={ids}"
-api_full_check_url = api_host + "/full/{id}?ts={ts}"
+api_full_check_url = api_host + "/full?ids={ids}"
 api_fast_check_max_ids = 10
+api_full_check_max_ids = 50
+api_shed_max_retries = 30
+api_shed_retry_delay = 2
+api_validators_max = 256
 
 app_update_endpoint = "https://api.github.com/repos/WillyJL/F95Checker/releases/latest"
 
@@ -120,6 +125,7 @@ fast_checks_sem: asyncio.Semaphore = None
 full_checks_sem: asyncio.Semaphore = None
 fast_checks_counter = 0
 full_checks_counter = CounterContext()
+api_validators: dict[str, tuple[str, bytes]] = {}
 images_counter = CounterContext()
 downloads: dict[str, FileDownload] = {}
 
@@ -248,6 +254,11 @@ async def request(method: str, url: str, read=True, cookies: dict = True, **kwar
     elif cookies is False:
         cookies = {}
     is_ratelimit_request = url.startswith(f95_host) and not url.startswith(f95_no_ratelimit_urls)
+    # Revalidate cache API responses we already have instead of downloading them again
+    is_validated_request = read and method == "GET" and url.startswith(api_host)
+    validator = api_validators.get(url) if is_validated_request else None
+    if validator:
+        kwargs["headers"] = {**kwargs.get("headers", {}), "If-None-Match": validator[0]}
     ratelimit_retries = 10
     ratelimit_sleep = 0
     _can_ratelimit = lambda: is_ratelimit_request and ratelimit_retries > 1
@@ -281,6 +292,14 @@ async def request(method: str, url: str, read=True, cookies: dict = True, **kwar
                 if _can_ratelimit() and any(msg in res for msg in f95_ratelimit_forum_errors):
                     await _do_ratelimit()
                     continue
+                if is_validated_request:
+                    if req.status == 304 and validator:
+                        res = validator[1]
+                    elif req.status == 200 and (etag := req.headers.get("ETag")):
+                        api_validators.pop(url, None)
+                        api_validators[url] = (etag, res)
+                        while len(api_validators) > api_validators_max:
+                            del api_validators[next(iter(api_validators))]
                 yield res, req
             break
         except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
@@ -674,38 +693,58 @@ def last_check_before(before_version: str, checked_version: str):
     return is_before
 
 
-async def fast_check(games: list[Game], full=False):
+async def fast_check(games: list[Game], full=False) -> list[tuple[Game, int, int | None]]:
     games = list(filter(lambda game: not game.custom, games))
 
     global fast_checks_counter
     fast_checks_counter += len(games)
+    last_changes = {}
     try:
         async with fast_checks_sem:
-            res = None
-            try:
-                res = await fetch("GET", api_fast_check_url.format(ids=",".join(str(game.id) for game in games)), timeout=120, cookies=False)
-                raise_api_error(res)
-                last_changes = json.loads(res)
-                raise_api_error(last_changes)
-            except Exception as exc:
-                if isinstance(exc, msgbox.Exc) or not res:
-                    raise exc
-                raise msgbox.Exc(
-                    "Fast check error",
-                    "Something went wrong checking some of your games:\n"
-                    f"{error.text()}\n"
-                    "\n"
-                    "Click below to see the response body and traceback.\n"
-                    "Please submit a bug report on F95zone or GitHub including these.",
-                    MsgBox.error,
-                    more=f"Response body:\n{str(res)[:10000]}\n\n{error.traceback()}",
-                )
+            pending = games
+            shed_retries = api_shed_max_retries
+            while pending:
+                res = None
+                try:
+                    async with request("GET", api_fast_check_url.format(ids=",".join(str(game.id) for game in pending)), timeout=120, cookies=False) as (res, req):
+                        pass
+                    if req.status == 429:
+                        # Cache API limits how many uncached threads each user can have scraped
+                        checked = {}
+                    else:
+                        raise_api_error(res)
+                        checked = json.loads(res)
+                        raise_api_error(checked)
+                    last_changes.update(checked)
+                except Exception as exc:
+                    if isinstance(exc, msgbox.Exc) or not res:
+                        raise exc
+                    raise msgbox.Exc(
+                        "Fast check error",
+                        "Something went wrong checking some of your games:\n"
+                        f"{error.text()}\n"
+                        "\n"
+                        "Click below to see the response body and traceback.\n"
+                        "Please submit a bug report on F95zone or GitHub including these.",
+                        MsgBox.error,
+                        more=f"Response body:\n{str(res)[:10000]}\n\n{error.traceback()}",
+                    )
+                # Threads left out were not scraped yet, ask again when the API allows it
+                pending = [game for game in pending if str(game.id) not in checked]
+                if not pending or not shed_retries:
+                    break
+                shed_retries -= 1
+                await asyncio.sleep(int(req.headers.get("Retry-After") or api_shed_retry_delay))
     finally:
         fast_checks_counter -= len(games)
 
-    full_queue: list[tuple[Game, int]] = []
+    full_queue: list[tuple[Game, int, int | None]] = []
     for game in games:
-        last_changed = last_changes.get(str(game.id), 0)
+        last_changed = last_changes.get(str(game.id))
+        if last_changed is None:
+            # Still limited after retrying, check it on next refresh
+            globals.refresh_progress += 1
+            continue
         assert last_changed > 0, "Invalid last_changed from fast check API"
 
         this_full = full or (
@@ -718,220 +757,304 @@ async def fast_check(games: list[Game], full=False):
             globals.refresh_progress += 1
             continue
 
-        full_queue.append((game, last_changed))
+        # Only fetch fields changed since last full check when nothing else needs a full refresh
+        since = None
+        if game.last_full_check and not full and not (
+            game.status is Status.Unchecked or
+            game.image.missing or
+            last_check_before("10.1.1", game.last_check_version)
+        ):
+            since = game.last_full_check
+
+        full_queue.append((game, last_changed, since))
+
+    return full_queue
+
+
+def _parse_downloads(downloads: str):
+    downloads = json.loads(downloads)
+    for label, links in downloads:
+        for link_i, link_pair in enumerate(links):
+            links[link_i] = tuple(link_pair)
+    return tuple(downloads)
+
+
+api_thread_fields = {
+    "name":          str,
+    "version":       str,
+    "developer":     str,
+    "type":          lambda type: Type(int(type)),
+    "status":        lambda status: Status(int(status)),
+    "last_updated":  int,
+    "score":         float,
+    "votes":         int,
+    "description":   str,
+    "changelog":     str,
+    "tags":          lambda tags: tuple(Tag(tag) for tag in json.loads(tags)),
+    "unknown_tags":  json.loads,
+    "image_url":     str,
+    "previews_urls": json.loads,
+    "downloads":     _parse_downloads,
+    "reviews_total": int,
+    "reviews":       lambda reviews: [Review(**review) for review in json.loads(reviews)],
+}
+
+
+async def full_check(full_queue: list[tuple[Game, int, int | None]]):
+    if not full_queue:
+        return
+    queue = {game.id: (game, last_changed, since) for game, last_changed, since in full_queue}
 
+    full_checks_counter.count += len(full_queue)
     tasks: list[asyncio.Task] = []
     try:
-        tasks = [asyncio.create_task(full_check(game, ts)) for game, ts in full_queue]
-        await asyncio.gather(*tasks)
+        async with full_checks_sem:
+            res = None
+            try:
+                ids = ",".join(
+                    f"{game.id}:{last_changed}" + (f":{since}" if since is not None else "")
+                    for game, last_changed, since in full_queue
+                )
+                # Streamed, so no ETag revalidation, only changed threads are asked for anyway
+                async with request("GET", api_full_check_url.format(ids=ids), read=False, timeout=globals.settings.request_timeout * 2, cookies=False) as (_, req):
+                    if req.content_type != "application/x-ndjson":
+                        res = await req.read()
+                        raise_api_error(res)
+                        raise Exception(f"Unexpected response status {req.status}")
+                    # Threads are streamed one per line as soon as they are ready
+                    res = b""
+                    async for chunk in req.content.iter_any():
+                        res += chunk
+                        *lines, res = res.split(b"\n")
+                        for line in lines:
+                            if not line.strip():
+                                continue
+                            full = json.loads(line)
+                            game, last_changed, since = queue.pop(full["id"])
+                            tasks.append(asyncio.create_task(full_check_apply(game, last_changed, since, full["status"], full["thread"])))
+                if queue:
+                    raise Exception(f"Response is missing {len(queue)} threads")
+            except Exception as exc:
+                if isinstance(exc, msgbox.Exc) or res is None:
+                    raise exc
+                raise msgbox.Exc(
+                    "Full check error",
+                    "Something went wrong checking some of your games:\n"
+                    f"{error.text()}\n"
+                    "\n"
+                    "Click below to see the response body and traceback.\n"
+                    "Please submit a bug report on F95zone or GitHub including these.",
+                    MsgBox.error,
+                    more=f"Response body:\n{str(res)[:10000]}\n\n{error.traceback()}",
+                )
+            await asyncio.gather(*tasks)
     except Exception:
         for task in tasks:
             task.cancel()
         raise
+    finally:
+        full_checks_counter.count -= len(full_queue)
 
 
-async def full_check(game: Game, last_changed: int):
-    async with full_checks_counter, full_checks_sem:
-
-        async with request("GET", api_full_check_url.format(id=game.id, ts=last_changed), timeout=globals.settings.request_timeout * 2, cookies=False) as (res, req):
-            raise_api_error(res)
-            if req.status in (403, 404):
-                if not game.archived:
-                    buttons = {
-                        f"{icons.cancel} Do nothing": None,
-                        f"{icons.trash_can_outline} Remove": lambda: callbacks.remove_game(game, bypass_confirm=True),
-                        f"{icons.puzzle_outline} Convert": lambda: callbacks.convert_f95zone_to_custom(game)
-                    }
-                    utils.push_popup(
-                        msgbox.msgbox, "Thread not found",
-                        "The F95zone thread for this game could not be found:\n"
-                        f"{game.name}\n"
-                        "It might have been privated, moved or deleted, maybe for breaking forum rules.\n"
-                        "\n"
-                        "You can remove this game from your library, or convert it to a custom game.\n"
-                        "Custom games are untied from F95zone and are not checked for updates, so\n"
-                        "you won't get this error anymore. You can later convert it back to an F95zone\n"
-                        "game from its info popup. You can also find more details there.",
-                        MsgBox.error,
-                        buttons=buttons
-                    )
-                globals.refresh_progress += 1
-                return
-            thread = json.loads(res)
-            raise_api_error(thread)
-            url = f95_threads_page + str(game.id)
-
-        # Redis only allows string values, so API only gives str for simplicity
-        thread["type"] = Type(int(thread["type"]))
-        thread["status"] = Status(int(thread["status"]))
-        thread["last_updated"] = int(thread["last_updated"])
-        thread["score"] = float(thread["score"])
-        thread["votes"] = int(thread["votes"])
-        thread["tags"] = tuple(Tag(tag) for tag in json.loads(thread["tags"]))
-        thread["unknown_tags"] = json.loads(thread["unknown_tags"])
-        thread["downloads"] = json.loads(thread["downloads"])
-        for label, links in thread["downloads"]:
-            for link_i, link_pair in enumerate(links):
-                links[link_i] = tuple(link_pair)
-        thread["previews_urls"] = json.loads(thread.get("previews_urls", "[]"))
-        thread["downloads"] = tuple(thread["downloads"])
-        thread["reviews_total"] = int(thread.get("reviews_total", "0"))
-        thread["reviews"] = json.loads(thread.get("reviews", "[]"))
-        thread["reviews"] = [Review(**review) for review in thread["reviews"]]
-
-        old_name = game.name
-        old_version = game.version
-        old_status = game.status
-
-        version = thread["version"]
-        if not version:
-            version = "N/A"
+async def full_check_apply(game: Game, last_changed: int, since: int | None, status: int, thread: dict[str, str]):
+    if status == 429:
+        # Cache API didn't scrape it for us yet, keep last_full_check so next refresh asks again
+        globals.refresh_progress += 1
+        return
+    if status in (403, 404):
+        if not game.archived:
+            buttons = {
+                f"{icons.cancel} Do nothing": None,
+                f"{icons.trash_can_outline} Remove": lambda: callbacks.remove_game(game, bypass_confirm=True),
+                f"{icons.puzzle_outline} Convert": lambda: callbacks.convert_f95zone_to_custom(game)
+            }
+            utils.push_popup(
+                msgbox.msgbox, "Thread not found",
+                "The F95zone thread for this game could not be found:\n"
+                f"{game.name}\n"
+                "It might have been privated, moved or deleted, maybe for breaking forum rules.\n"
+                "\n"
+                "You can remove this game from your library, or convert it to a custom game.\n"
+                "Custom games are untied from F95zone and are not checked for updates, so\n"
+                "you won't get this error anymore. You can later convert it back to an F95zone\n"
+                "game from its info popup. You can also find more details there.",
+                MsgBox.error,
+                buttons=buttons
+            )
+        globals.refresh_progress += 1
+        return
+    raise_api_error(thread)
+    url = f95_threads_page + str(game.id)
+
+    if since is None:
+        # Might be missing from older API versions
+        thread.setdefault("previews_urls", "[]")
+        thread.setdefault("reviews_total", "0")
+        thread.setdefault("reviews", "[]")
+
+    # Redis only allows string values, so API only gives str for simplicity
+    for key, parse in api_thread_fields.items():
+        if key in thread:
+            thread[key] = parse(thread[key])
+        elif since is not None:
+            # Delta response only includes changed fields, keep current data for the rest
+            thread[key] = getattr(game, key)
+            if isinstance(thread[key], Timestamp):
+                thread[key] = thread[key].value
+
+    old_name = game.name
+    old_version = game.version
+    old_status = game.status
+
+    version = thread["version"]
+    if not version:
+        version = "N/A"
+
+    if old_status is not Status.Unchecked:
+        if game.developer != thread["developer"]:
+            game.add_timeline_event(TimelineEventType.ChangedDeveloper, game.developer, thread["developer"])
+
+        if game.type != thread["type"]:
+            game.add_timeline_event(TimelineEventType.ChangedType, game.type.name, thread["type"].name)
+
+        if game.tags != thread["tags"]:
+            if difference := [tag.text for tag in thread["tags"] if tag not in game.tags]:
+                game.add_timeline_event(TimelineEventType.TagsAdded, ", ".join(difference))
+            if difference := [tag.text for tag in game.tags if tag not in thread["tags"]]:
+                game.add_timeline_event(TimelineEventType.TagsRemoved, ", ".join(difference))
+
+        if game.score != thread["score"]:
+            if game.score < thread["score"]:
+                game.add_timeline_event(TimelineEventType.ScoreIncreased, game.score, game.votes, thread["score"], thread["votes"])
+            else:
+                game.add_timeline_event(TimelineEventType.ScoreDecreased, game.score, game.votes, thread["score"], thread["votes"])
+
+    breaking_name_parsing    = last_check_before("9.6.4",  game.last_check_version)  # Skip name change in update popup
+    breaking_version_parsing = last_check_before("10.1.1", game.last_check_version)  # Skip update popup and keep installed/finished checkboxes
+    breaking_keep_old_image  = last_check_before("9.0",    game.last_check_version)  # Keep existing image files
+
+    last_full_check = last_changed
+    last_check_version = globals.version
+
+    # Skip update popup and don't reset finished/installed checkboxes if refreshing with braking changes
+    finished = game.finished
+    installed = game.installed
+    updated = game.updated
+    if breaking_version_parsing or old_status is Status.Unchecked:
+        if old_version == finished:
+            finished = version  # Is breaking and was previously finished, mark again as finished
+        if old_version == installed:
+            installed = version  # Is breaking and was previously installed, mark again as installed
+        old_version = version  # Don't include version change in popup for simple parsing adjustments
+    else:
+        if version != old_version:
+            if not game.archived:
+                updated = True
+
+    # Don't include name change in popup for simple parsing adjustments
+    if breaking_name_parsing:
+        old_name = thread["name"]
+
+    fetch_image = game.image.missing
+    if game.image_url != "custom" and not breaking_keep_old_image:
+        fetch_image = fetch_image or (thread["image_url"] != game.image_url)
+
+    unknown_tags_flag = game.unknown_tags_flag
+    if len(thread["unknown_tags"]) > 0 and game.unknown_tags != thread["unknown_tags"]:
+        unknown_tags_flag = True
+
+    async def update_game():
+        game.name = thread["name"]
+        game.version = version
+        game.developer = thread["developer"]
+        game.type = thread["type"]
+        game.status = thread["status"]
+        game.url = url
+        game.last_updated = thread["last_updated"]
+        game.last_full_check = last_full_check
+        game.last_check_version = last_check_version
+        game.score = thread["score"]
+        game.votes = thread["votes"]
+        game.finished = finished
+        game.installed = installed
+        game.updated = updated
+        game.description = thread["description"]
+        game.changelog = thread["changelog"]
+        game.tags = thread["tags"]
+        game.unknown_tags = thread["unknown_tags"]
+        game.unknown_tags_flag = unknown_tags_flag
+        if fetch_image:
+            game.image_url = thread["image_url"]
+        game.previews_urls = thread["previews_urls"]
+        game.downloads = thread["downloads"]
+        game.reviews_total = thread["reviews_total"]
+        game.reviews = thread["reviews"]
+
+        changed_name = thread["name"] != old_name
+        changed_status = thread["status"] != old_status
+        changed_version = version != old_version
 
         if old_status is not Status.Unchecked:
-            if game.developer != thread["developer"]:
-                game.add_timeline_event(TimelineEventType.ChangedDeveloper, game.developer, thread["developer"])
-
-            if game.type != thread["type"]:
-                game.add_timeline_event(TimelineEventType.ChangedType, game.type.name, thread["type"].name)
-
-            if game.tags != thread["tags"]:
-                if difference := [tag.text for tag in thread["tags"] if tag not in game.tags]:
-                    game.add_timeline_event(TimelineEventType.TagsAdded, ", ".join(difference))
-                if difference := [tag.text for tag in game.tags if tag not in thread["tags"]]:
-                    game.add_timeline_event(TimelineEventType.TagsRemoved, ", ".join(difference))
-
-            if game.score != thread["score"]:
-                if game.score < thread["score"]:
-                    game.add_timeline_event(TimelineEventType.ScoreIncreased, game.score, game.votes, thread["score"], thread["votes"])
-                else:
-                    game.add_timeline_event(TimelineEventType.ScoreDecreased, game.score, game.votes, thread["score"], thread["votes"])
-
-        breaking_name_parsing    = last_check_before("9.6.4",  game.last_check_version)  # Skip name change in update popup
-        breaking_version_parsing = last_check_before("10.1.1", game.last_check_version)  # Skip update popup and keep installed/finished checkboxes
-        breaking_keep_old_image  = last_check_before("9.0",    game.last_check_version)  # Keep existing image files
-
-        last_full_check = last_changed
-        last_check_version = globals.version
-
-        # Skip update popup and don't reset finished/installed checkboxes if refreshing with braking changes
-        finished = game.finished
-        installed = game.installed
-        updated = game.updated
-        if breaking_version_parsing or old_status is Status.Unchecked:
-            if old_version == finished:
-                finished = version  # Is breaking and was previously finished, mark again as finished
-            if old_version == installed:
-                installed = version  # Is breaking and was previously installed, mark again as installed
-            old_version = version  # Don't include version change in popup for simple parsing adjustments
-        else:
-            if version != old_version:
-                if not game.archived:
-                    updated = True
-
-        # Don't include name change in popup for simple parsing adjustments
-        if breaking_name_parsing:
-            old_name = thread["name"]
-
-        fetch_image = game.image.missing
-        if game.image_url != "custom" and not breaking_keep_old_image:
-            fetch_image = fetch_image or (thread["image_url"] != game.image_url)
-
-        unknown_tags_flag = game.unknown_tags_flag
-        if len(thread["unknown_tags"]) > 0 and game.unknown_tags != thread["unknown_tags"]:
-            unknown_tags_flag = True
-
-        async def update_game():
-            game.name = thread["name"]
-            game.version = version
-            game.developer = thread["developer"]
-            game.type = thread["type"]
-            game.status = thread["status"]
-            game.url = url
-            game.last_updated = thread["last_updated"]
-            game.last_full_check = last_full_check
-            game.last_check_version = last_check_version
-            game.score = thread["score"]
-            game.votes = thread["votes"]
-            game.finished = finished
-            game.installed = installed
-            game.updated = updated
-            game.description = thread["description"]
-            game.changelog = thread["changelog"]
-            game.tags = thread["tags"]
-            game.unknown_tags = thread["unknown_tags"]
-            game.unknown_tags_flag = unknown_tags_flag
-            if fetch_image:
-                game.image_url = thread["image_url"]
-            game.previews_urls = thread["previews_urls"]
-            game.downloads = thread["downloads"]
-            game.reviews_total = thread["reviews_total"]
-            game.reviews = thread["reviews"]
-
-            changed_name = thread["name"] != old_name
-            changed_status = thread["status"] != old_status
-            changed_version = version != old_version
-
-            if old_status is not Status.Unchecked:
-                if changed_name:
-                    game.add_timeline_event(TimelineEventType.ChangedName, old_name, game.name)
-                if changed_status:
-                    game.add_timeline_event(TimelineEventType.ChangedStatus, old_status.name, game.status.name)
-                if changed_version:
-                    game.add_timeline_event(TimelineEventType.ChangedVersion, old_version, game.version)
-
-            if not game.archived and old_status is not Status.Unchecked and (
-                changed_name or changed_status or changed_version
-            ):
-                old_game = OldGame(
-                    id=game.id,
-                    name=old_name,
-                    version=old_version,
-                    status=old_status,
-                )
-                globals.new_updated_games[game.id] = old_game
+            if changed_name:
+                game.add_timeline_event(TimelineEventType.ChangedName, old_name, game.name)
+            if changed_status:
+                game.add_timeline_event(TimelineEventType.ChangedStatus, old_status.name, game.status.name)
+            if changed_version:
+                game.add_timeline_event(TimelineEventType.ChangedVersion, old_version, game.version)
+
+        if not game.archived and old_status is not Status.Unchecked and (
+            changed_name or changed_status or changed_version
+        ):
+            old_game = OldGame(
+                id=game.id,
+                name=old_name,
+                version=old_version,
+                status=old_status,
+            )
+            globals.new_updated_games[game.id] = old_game
 
-        if fetch_image and thread["image_url"] and thread["image_url"].startswith("http"):
-            with images_counter:
-                image_url = thread["image_url"]
-                while True:
-                    try:
-                        res = await fetch("GET", image_url, timeout=globals.settings.request_timeout * 4, raise_for_status=True)
-                    except aiohttp.ClientResponseError as exc:
-                        if exc.status < 400:
-                            raise  # Not error status
-                        if image_url.startswith("https://i.imgur.com"):
-                            thread["image_url"] = "blocked"
-                        else:
-                            thread["image_url"] = "dead"
+    if fetch_image and thread["image_url"] and thread["image_url"].startswith("http"):
+        with images_counter:
+            image_url = thread["image_url"]
+            while True:
+                try:
+                    res = await fetch("GET", image_url, timeout=globals.settings.request_timeout * 4, raise_for_status=True)
+                except aiohttp.ClientResponseError as exc:
+                    if exc.status < 400:
+                        raise  # Not error status
+                    if image_url.startswith("https://i.imgur.com"):
+                        thread["image_url"] = "blocked"
+                    else:
+                        thread["image_url"] = "dead"
+                    res = b""
+                except aiohttp.ClientConnectorError as exc:
+                    # Try alternative F95zone hosts (-1 because we're checking to then use the next link)
+                    changed_host = False
+                    for host_i in range(len(f95_attachments_hosts) - 1):
+                        if image_url.startswith(f95_attachments_hosts[host_i]):
+                            image_url = f95_attachments_hosts[host_i + 1] + image_url.removeprefix(f95_attachments_hosts[host_i])
+                            changed_host = True
+                            break
+                    if changed_host:
+                        continue
+                    if not isinstance(exc.os_error, socket.gaierror):
+                        raise  # Not a dead link
+                    if is_f95zone_url(image_url):
+                        raise  # Not a foreign host, raise normal connection error message
+                    if check_host(f95_domain) and not check_host(get_url_domain(image_url)):
+                        # Link is actually dead
+                        thread["image_url"] = "dead"
                         res = b""
-                    except aiohttp.ClientConnectorError as exc:
-                        # Try alternative F95zone hosts (-1 because we're checking to then use the next link)
-                        changed_host = False
-                        for host_i in range(len(f95_attachments_hosts) - 1):
-                            if image_url.startswith(f95_attachments_hosts[host_i]):
-                                image_url = f95_attachments_hosts[host_i + 1] + image_url.removeprefix(f95_attachments_hosts[host_i])
-                                changed_host = True
-                                break
-                        if changed_host:
-                            continue
-                        if not isinstance(exc.os_error, socket.gaierror):
-                            raise  # Not a dead link
-                        if is_f95zone_url(image_url):
-                            raise  # Not a foreign host, raise normal connection error message
-                        if check_host(f95_domain) and not check_host(get_url_domain(image_url)):
-                            # Link is actually dead
-                            thread["image_url"] = "dead"
-                            res = b""
-                        else:
-                            raise  # Foreign host might not actually be dead
-                    break  # Loop is only to retry with `continue`
-                async def set_image_and_update_game():
-                    await game.set_image_async(res)
-                    await update_game()
-                await asyncio.shield(set_image_and_update_game())
-        else:
-            await asyncio.shield(update_game())
-        globals.refresh_progress += 1
+                    else:
+                        raise  # Foreign host might not actually be dead
+                break  # Loop is only to retry with `continue`
+            async def set_image_and_update_game():
+                await game.set_image_async(res)
+                await update_game()
+            await asyncio.shield(set_image_and_update_game())
+    else:
+        await asyncio.shield(update_game())
+    globals.refresh_progress += 1
 
 
 async def check_notifs(standalone=True, retry=False):
@@ -1270,12 +1393,28 @@ async def refresh(*games: list[Game], full=False, notifs=True, force_archived=Fa
     fast_checks_sem = asyncio.Semaphore(1)
     full_checks_sem = asyncio.Semaphore(globals.settings.max_connections)
     fast_checks_counter = 0
+    full_queue: list[tuple[Game, int, int | None]] = []
     tasks: list[asyncio.Task] = []
+    full_tasks: list[asyncio.Task] = []
+
+    # Fast checks are chunked smaller than full checks, so collect what they
+    # find across chunks and send full checks in as few bulk requests as possible
+    def queue_full_checks(min_size: int):
+        while full_queue and len(full_queue) >= min_size:
+            full_tasks.append(asyncio.create_task(full_check(full_queue[:api_full_check_max_ids])))
+            del full_queue[:api_full_check_max_ids]
+
+    async def fast_check_chunk(chunk: list[Game]):
+        full_queue.extend(await fast_check(chunk, full=full))
+        queue_full_checks(api_full_check_max_ids)
+
     try:
-        tasks = [asyncio.create_task(fast_check(chunk, full=full)) for chunk in fast_queue]
+        tasks = [asyncio.create_task(fast_check_chunk(chunk)) for chunk in fast_queue]
         await asyncio.gather(*tasks)
+        queue_full_checks(1)
+        await asyncio.gather(*full_tasks)
     except Exception:
-        for task in tasks:
+        for task in (*tasks, *full_tasks):
             task.cancel()
         fast_checks_sem = None
         full_checks_sem = None